@@ -26,20 +26,21 @@ import flask
 import os
 import yaml
 import mwoauth
-import requests
+import httpclient
 import json
 import md5
 import codecs
 import re
 import datetime
 import jinja2
-from random import randint
 from requests_oauthlib import OAuth1
 import mwparserfromhell
 import main
 from difflib import HtmlDiff
 import wikirender
 from userstats import UserStats
+from jobs import JobManager
+from proposals import normalize_title
 
 import urllib3
 import urllib3.contrib.pyopenssl
@@ -54,10 +55,14 @@ app.config.update(
 
 app.jinja_env.filters['wikirender'] = wikirender.wikirender
 
+# pages are processed in background jobs, shared by all the
+# processes of the app through the proposals database
+job_manager = JobManager(main.proposal_store)
+
 class InvalidUsage(Exception):
     status_code = 400
 
-    def __init__(self, message, status_code=None):
+    def __init__(self, message, status_code=None, payload=None):
         Exception.__init__(self)
         self.message = message
         if status_code is not None:
@@ -67,8 +72,7 @@ class InvalidUsage(Exception):
 @app.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
     response = flask.render_template("error.html", message=error.message)
-    response.status_code = error.status_code
-    return response
+    return response, error.status_code
 
 @app.errorhandler(Exception)
 def handle_invalid_usage(error):
@@ -86,7 +90,7 @@ def index():
     }
     return flask.render_template("index.html", **context)
 
-def edit_wiki_page(page_name, content, summary=None):
+def edit_wiki_page(page_name, content, summary=None, base_revid=None):
     access_token = flask.session.get('access_token', None)
     auth = OAuth1(
 		app.config['CONSUMER_KEY'],
@@ -95,7 +99,7 @@ def edit_wiki_page(page_name, content, summary=None):
 		access_token['secret'])
 
     # Get token
-    r = requests.get('https://en.wikipedia.org/w/api.php', params={
+    r = httpclient.get('https://en.wikipedia.org/w/api.php', params={
 	'action':'query',
 	'meta':'tokens',
         'format': 'json',
@@ -103,7 +107,7 @@ def edit_wiki_page(page_name, content, summary=None):
     r.raise_for_status()
     token = r.json()['query']['tokens']['csrftoken']
     
-    r = requests.post('https://en.wikipedia.org/w/api.php', data={
+    r = httpclient.post('https://en.wikipedia.org/w/api.php', data={
 	'action':'edit',
         'title': page_name,
 	'text': content,
@@ -111,15 +115,35 @@ def edit_wiki_page(page_name, content, summary=None):
         'format': 'json',
         'token': token,
         'watchlist': 'nochange',
+        # detects edits made since we fetched the page
+        'baserevid': base_revid,
     }, auth=auth)
     r.raise_for_status()
+    error = r.json().get('error')
+    if error:
+        raise InvalidUsage('The page could not be edited: %s' % error.get('info'), 409)
 	
 
 @app.route('/process')
 def process():
     page_name = flask.request.args.get('name')
+    if not page_name:
+        raise InvalidUsage('Page title is required')
     force = flask.request.args.get('refresh') == 'true'
-    context =  get_proposed_edits(page_name, force)
+    if not force and main.proposal_store.has_page(page_name):
+        context = get_proposed_edits(page_name, force)
+        # normally rendered when the proposals were stored
+        wikirender.prerender([edit['orig_string']
+                              for edit in context['proposed_edits']])
+    else:
+        # processed in the background: the page polls the job
+        job_id = job_manager.submit(normalize_title(page_name), get_proposed_edits,
+                        page_name, force)
+        context = {
+            'page_name': page_name,
+            'job_id': job_id,
+            'proposed_edits': [],
+        }
     username = flask.session.get('username', None)
     nb_edits = 0
     if username:
@@ -128,6 +152,29 @@ def process():
     context['nb_edits'] = nb_edits
     return flask.render_template('change.html', **context)
 
+@app.route('/job-status')
+def job_status():
+    """
+    Polled by the browser while a page is processed: returns the
+    proposals found after the first `since` ones, rendered in HTML
+    """
+    progress = job_manager.progress(flask.request.args.get('id'),
+                    int(flask.request.args.get('since', 0)))
+    if progress is None:
+        raise InvalidUsage('Unknown job', status_code=404)
+    context = progress['context'] or {}
+    wikirender.prerender([edit['orig_string'] for edit in progress['edits']])
+    return flask.jsonify({
+        'status': progress['status'],
+        'next': progress['next'],
+        'fragments': [flask.render_template('edit-item.html', template_edit=edit)
+                      for edit in progress['edits']],
+        'error': progress['error'],
+        'page_name': context.get('page_name'),
+        'nb_incomplete': context.get('nb_incomplete', 0),
+        'unavailable_hosts': context.get('unavailable_hosts', []),
+    })
+
 @app.route('/review-edit')
 def review_one_edit():
     page_name = flask.request.args.get('name')
@@ -142,23 +189,11 @@ def review_one_edit():
     return flask.render_template('one-edit.html', **context)
 
 
-def to_cache_name(page_name):
-    safe_page_name = page_name.replace('/','#').replace(' ','_')
-    if type(safe_page_name) == unicode:
-        safe_page_name = safe_page_name.encode('utf-8')
-    cache_fname = '%s.json' % safe_page_name
-    return cache_fname
-
-def from_cache_name(cache_fname):
-    return cache_fname[:-5].replace('_',' ').replace('#','/')
-
-def list_cache_contents():
-    for (_, _, fnames) in os.walk('cache/'):
-        return map(from_cache_name, fnames)
-
 def refresh_whole_cache():
-    for page_name in list_cache_contents():
-        get_proposed_edits(page_name, True)
+    # the pages are fetched by batches
+    for page_name, page in main.iter_pages_over_api(main.proposal_store.page_titles()):
+        if page is not None:
+            get_proposed_edits(page_name, True, page=page)
 
 @app.route('/get-random-edit')
 def get_random_edit():
@@ -167,60 +202,95 @@ def get_random_edit():
     if not access_token:
         return flask.redirect(flask.url_for('login', next_url=flask.url_for('get_random_edit')))
 
-    # Then, redirect to a random cached edit
-    cached_pages = list_cache_contents()
-    if not cached_pages:
+    # Then, redirect to a random cached edit, reserved for this user
+    # so that other reviewers get different edits meanwhile
+    username = flask.session.get('username', None)
+    if username:
+        random_edit = main.proposal_store.lease_edit(username)
+    else:
+        random_edit = main.proposal_store.random_edit()
+    if random_edit is None:
         return flask.redirect(flask.url_for('index'))
-    idx = randint(0,len(cached_pages)-1)
-    page_name = cached_pages[idx]
-    cache_fname = "cache/"+to_cache_name(page_name)
-    with open(cache_fname, 'r') as f:
-        page_json = json.load(f)
-
-    proposed_edits = page_json.get('proposed_edits', [])
-    if proposed_edits:
-        edit_idx = randint(0, len(proposed_edits)-1)
-        orig_hash = proposed_edits[edit_idx]['orig_hash']
-        return flask.redirect(
-            flask.url_for('review_one_edit', name=cached_pages[idx], edit=orig_hash))
+    page_name, edit = random_edit
+    return flask.redirect(
+        flask.url_for('review_one_edit', name=page_name, edit=edit['orig_hash']))
 
-    return flask.redirect(flask.url_for('index'))
-
-redirect_re = re.compile(r'#REDIRECT *\[\[(.*)\]\]')
-
-def get_proposed_edits(page_name, force, follow_redirects=True):
-    # Get the page
-    text = main.get_page_over_api(page_name)
-
-    # See if it's a redirect
-    redir = redirect_re.match(text)
-    if redir:
-        return get_proposed_edits(redir.group(1), force, False)
+def get_proposed_edits(page_name, force, follow_redirects=True, page=None,
+                    on_edit=None):
+    """
+    :param page: the page, if it has already been fetched
+        with main.get_pages_over_api
+    :param on_edit: called with each proposed edit (as a JSON dict)
+        as soon as it is found
+    """
+    # Get the title and latest revision of the page
+    # (redirects are followed by the API)
+    info = page or main.get_page_info_over_api(page_name, follow_redirects)
+    page_name = info['title']
+
+    # See if we already have it cached: if the page has not changed,
+    # its contents are not needed
+    if not force:
+        context = main.proposal_store.get_page(page_name)
+        if context is not None:
+            if context['revid'] == info['revid']:
+                return context
+            return revalidate_proposals(context,
+                        page or main.get_page(page_name, info=info))
 
-    # See if we already have it cached
-    cache_fname = "cache/"+to_cache_name(page_name)
-    if not force and os.path.isfile(cache_fname):
-        with open(cache_fname, 'r') as f:
-            return json.load(f)
-    
     # Otherwise, process it
-    all_templates = main.add_oa_links_in_references(text, page_name)
+    if page is None:
+        page = main.get_page(page_name, info=info)
+    text = page['text']
+    all_templates = []
+    for edit in main.add_oa_links_in_references(text, page_name):
+        all_templates.append(edit)
+        if on_edit and edit.proposed_change:
+            on_edit(edit.json())
     filtered = list(filter(lambda e: e.proposed_change, all_templates))
+    # citations we could not resolve in time or because an API was down
+    incomplete = [e for e in all_templates
+                  if e.classification in ('timed_out', 'host_unavailable')]
     context = {
 	'proposed_edits': [change.json() for change in filtered],
 	'page_name' : page_name,
+        'revid': page['revid'],
+        'timestamp': page['timestamp'],
+        'pageviews': page.get('pageviews', 0),
         'utcnow': unicode(datetime.datetime.utcnow()),
+        'nb_incomplete': len(incomplete),
+        'unavailable_hosts': sorted(set(e.unavailable_host for e in incomplete
+                                        if e.unavailable_host)),
     }
 
     if filtered:
-        # Cache the result
-        with open(cache_fname, 'w') as f:
-            json.dump(context, f)
-    elif os.path.isfile(cache_fname):
-        os.remove(cache_fname)
+        # Cache the result, rendering the templates in advance
+        # so that viewing the page does not require parsing them.
+        # Citations which could not be checked are counted in
+        # nb_incomplete: a refresh of the page will check them again.
+        wikirender.prerender([edit['orig_string']
+                              for edit in context['proposed_edits']])
+        main.proposal_store.store_page(context)
+    else:
+        main.proposal_store.remove_page(page_name)
     
     return context
 
+def revalidate_proposals(context, page):
+    """
+    The page has changed since its proposals were computed:
+    keep those whose template is still in the page
+    """
+    kept = [edit for edit in context['proposed_edits']
+            if edit['orig_string'] in page['text']]
+    main.proposal_store.update_revision(context['page_name'],
+            page['revid'], page['timestamp'],
+            [edit['orig_hash'] for edit in kept])
+    context['proposed_edits'] = kept
+    context['revid'] = page['revid']
+    context['timestamp'] = page['timestamp']
+    return context
+
 def get_one_proposed_edit(page_name, edit_hash):
     context = get_proposed_edits(page_name, False, True)
     for edit in context['proposed_edits']:
@@ -265,26 +335,26 @@ def perform_edit():
         raise InvalidUsage('No summary provided')
         
     # Get the page
-    text = main.get_page_over_api(page_name)
+    page = main.get_page(page_name, follow_redirects=False)
+    text = page['text']
     
     # Perform each edit
     new_text, change_made = make_new_wikicode(text, data, page_name)
 
     # Save the page
     if change_made:
-        edit_wiki_page(page_name, new_text, summary)
+        edit_wiki_page(page_name, new_text, summary, page['revid'])
         UserStats.increment_user(
             'en',
             flask.session.get('username', None),
             1, 1)
 
         # Remove the cache
-        cache_fname = "cache/"+to_cache_name(page_name)
-        if os.path.isfile(cache_fname):
-            os.remove(cache_fname)
+        main.proposal_store.remove_page(page_name)
 
         return flask.redirect(flask.url_for('get_random_edit'))
     else:
+        main.proposal_store.release_leases(flask.session.get('username', None))
         return flask.redirect(flask.url_for('index', success='nothing'))
 
 
@@ -330,6 +400,25 @@ def stats():
     }
     return flask.render_template("stats.html", **context)
 
+@app.route('/check-stats')
+def check_stats():
+    """
+    How many URLs were discarded by the probes, sent directly to
+    the PDF classifier or translated by Zotero, in this process
+    """
+    return flask.jsonify(main.check_counts.as_dict())
+
+@app.route('/cache-stats')
+def cache_stats():
+    """
+    Hit ratios of the caches since this process started
+    (cachetool.py runs in its own process, where they are unknown)
+    """
+    return flask.jsonify({
+        'urls': main.urls_cache.lookup_stats(),
+        'oa_links': main.oa_links_cache.lookup_stats(),
+    })
+
 
 
 @app.route('/login')
@@ -0,0 +1,60 @@
+# -*- encoding: utf-8 -*-
+"""
+Compares the fast page counter (pdfpages) with PyPDF2
+on a local directory of PDF files.
+
+Usage:
+  benchmark_pagecount.py [--repeat=<n>] <directory>
+
+Options:
+  --repeat=<n>  Number of times each file is processed [default: 3]
+"""
+from __future__ import unicode_literals
+import os
+import time
+from StringIO import StringIO
+from docopt import docopt
+import PyPDF2
+import pdfpages
+
+def pypdf_count(data):
+    try:
+        return PyPDF2.PdfFileReader(StringIO(data)).getNumPages()
+    except Exception:
+        return None
+
+def timed(fun, data, repeat):
+    start = time.time()
+    for i in range(repeat):
+        result = fun(data)
+    return result, (time.time() - start) / repeat
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+    fast_total = 0.
+    slow_total = 0.
+    stats = {'files': 0, 'fast_path': 0, 'agree': 0, 'disagree': 0}
+
+    for fname in sorted(os.listdir(args['<directory>'])):
+        if not fname.lower().endswith('.pdf'):
+            continue
+        with open(os.path.join(args['<directory>'], fname), 'rb') as f:
+            data = f.read()
+        fast, fast_time = timed(pdfpages.count_pages, data, repeat)
+        slow, slow_time = timed(pypdf_count, data, repeat)
+        fast_total += fast_time
+        slow_total += slow_time
+        stats['files'] += 1
+        if fast is not None:
+            stats['fast_path'] += 1
+            if slow is not None:
+                stats['agree' if fast == slow else 'disagree'] += 1
+        print('%-50s fast: %5s %8.2f ms   pypdf: %5s %8.2f ms' % (
+            fname[:50], fast, 1000*fast_time, slow, 1000*slow_time))
+
+    print('')
+    print('%(files)d files, fast path conclusive on %(fast_path)d '
+          '(%(agree)d agree with PyPDF2, %(disagree)d disagree)' % stats)
+    print('total time: fast %.2f ms, pypdf %.2f ms' % (
+        1000*fast_total, 1000*slow_total))
@@ -0,0 +1,94 @@
+# -*- encoding: utf-8 -*-
+"""
+Inspects and maintains the caches of OAbot.
+
+Usage:
+  cachetool.py stats [--domains=<n>] [<cache>...]
+  cachetool.py compact [<cache>...]
+  cachetool.py snapshot
+  cachetool.py print <cache>
+  cachetool.py ranking [--rebuild] [--domains=<n>]
+  cachetool.py import-proposals <directory>
+
+Caches are 'urls' (free-to-read checks), 'oa_links' (resolved
+citations) and 'domain_stats' (statistics used to rank links).
+By default, all caches are processed.
+
+Commands:
+  stats     Counts entries by outcome and age, lists the largest domains
+            (the hit ratios of the running app are served at /cache-stats)
+  compact   Prunes expired entries, merges equivalent URLs and rewrites
+            the storage
+  snapshot  Publishes a new shared snapshot of the URLs cache
+  print     Prints every entry of a cache
+  ranking   Lists the domains with the most checks, with their hit rate,
+            latency and score. With --rebuild, the hit rates are first
+            recomputed from the outcomes stored in the URLs cache
+  import-proposals
+            Imports the proposed edits stored as JSON files in a
+            directory (formerly cache/) in the proposals database
+
+Options:
+  --domains=<n>  Number of domains to list [default: 10]
+"""
+from __future__ import unicode_literals
+from docopt import docopt
+import main
+from ondiskcache import TRANSIENT_FAILURE
+
+caches = {
+    'urls': main.urls_cache,
+    'oa_links': main.oa_links_cache,
+    'domain_stats': main.domain_stats_cache,
+}
+
+def print_stats(name, stats):
+    print('%s: %d entries (%d expired), %d in memory' % (
+        name, stats['entries'], stats['expired'], stats['in_memory']))
+    for outcome, count in sorted(stats['by_outcome'].items()):
+        print('  %-12s %d' % (outcome, count))
+    for age, count in sorted(stats['by_age'].items()):
+        print('  %-12s %d' % (age, count))
+    if stats['top_domains']:
+        print('  largest domains:')
+        for domain, count in stats['top_domains']:
+            print('    %-40s %d' % (domain, count))
+
+def print_ranking(stats, nb_domains):
+    domains = sorted(((v[0], k) for k, (d, v) in stats.store.iteritems()),
+                    reverse=True)[:nb_domains]
+    print('%-40s %8s %8s %8s %8s' % ('domain', 'checks', 'hit rate', 'latency', 'score'))
+    for checks, domain in domains:
+        print('%-40s %8d %8.2f %8.2f %8.3f' % (domain, checks,
+            stats.hit_rate(domain), stats.latency(domain), stats.score(domain)))
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    names = args['<cache>'] or sorted(caches.keys())
+    for name in names:
+        if name not in caches:
+            raise ValueError('Unknown cache: %s' % name)
+
+    if args['stats']:
+        for name in names:
+            print_stats(name, caches[name].stats(int(args['--domains'])))
+    elif args['compact']:
+        for name in names:
+            caches[name].compact()
+            print('%s: compacted' % name)
+    elif args['snapshot']:
+        main.urls_cache.publish_snapshot()
+        print('urls: snapshot published')
+    elif args['print']:
+        caches[names[0]].print_contents()
+    elif args['import-proposals']:
+        nb = main.proposal_store.import_directory(args['<directory>'])
+        print('%d pages imported' % nb)
+    elif args['ranking']:
+        if args['--rebuild']:
+            outcomes = ((url, None if val is TRANSIENT_FAILURE else bool(val))
+                        for url, (d, val) in main.urls_cache.iteritems())
+            nb = main.domain_stats.rebuild(outcomes)
+            main.domain_stats_cache.save()
+            print('hit rates recomputed for %d domains' % nb)
+        print_ranking(main.domain_stats, int(args['--domains']))
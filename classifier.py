@@ -2,44 +2,287 @@
 from __future__ import unicode_literals
 
 from settings import *
+from ondiskcache import OnDiskCache, TRANSIENT_FAILURE
+from datetime import timedelta
 import subprocess32 as subprocess
 import tempfile
 import shutil
 import os
+import socket
+import hashlib
+import threading
 import requests
-import PyPDF2
-from PyPDF2.utils import PyPdfError
-from StringIO import StringIO
+import httpclient
+import pdfpages
+from pdfworkers import pdf_pool
+from jvmworker import jvm_pool, WorkerError
+from deadlines import DeadlineExceeded
 
 class RunnableError(Exception):
     pass
 
+class PdfReadTimeout(requests.exceptions.Timeout):
+    """
+    Raised when a PDF could not be read within OABOT_PDF_READ_DEADLINE
+    """
+    pass
+
+class ReadWatchdog(object):
+    """
+    Shuts down the connection of a streamed response after `seconds`.
+    Reads block until a whole chunk has arrived, so checking the time
+    between chunks does not stop servers which send data very slowly:
+    shutting the socket down interrupts the read in progress.
+    """
+    def __init__(self, r, seconds):
+        self.r = r
+        self.expired = False
+        self.timer = threading.Timer(seconds, self.expire)
+        self.timer.daemon = True
+
+    def expire(self):
+        self.expired = True
+        sock = getattr(getattr(self.r.raw, '_connection', None), 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def __enter__(self):
+        self.timer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.cancel()
+
+pdf_magic = b'%PDF-'
+
+# returned by fetch_pdf when the server answers 304 Not Modified
+NOT_MODIFIED = 'not_modified'
 
 class AcademicPaperFilter(object):
+   def __init__(self, digests_path='pdf_digests.sqlite',
+                validators_path='pdf_validators.sqlite'):
+        """
+        :param digests_path: the cache of classification results,
+            keyed by the SHA1 digest of the PDF files
+        :param validators_path: the cache of the validators (ETag,
+            Last-Modified) and digest of the last file seen at each URL
+        """
+        self.digests = OnDiskCache(digests_path,
+                    ttl=timedelta(days=OABOT_PDF_DIGESTS_TTL),
+                    capacity=OABOT_CACHE_CAPACITY)
+        self.validators = OnDiskCache(validators_path,
+                    ttl=timedelta(days=OABOT_PDF_VALIDATORS_TTL),
+                    capacity=OABOT_CACHE_CAPACITY)
+        for cache in [self.digests, self.validators]:
+            cache.start_flushing(OABOT_CACHE_FLUSH_INTERVAL,
+                    OABOT_CACHE_FLUSH_BATCH)
+
    def classify_url(self, url):
         """
         Download a potential PDF file at a given URL and
         check if it looks like a legitimate scholarly paper.
+        Returns TRANSIENT_FAILURE if the download failed.
+
+        Complete files are identified by their digest, so that copies
+        served at different URLs are only classified once. If we have seen
+        the URL before, the download is conditional: when the file
+        has not changed, its previous classification is reused.
         """
+        etag, last_modified, digest = self.validators.get(url) or (None, None, None)
         try:
-            r = requests.get(url, headers={'User-Agent':
-                    OABOT_USER_AGENT}, verify=False)
-            return self.check_nb_pages(r.content)
+            fetched = self.fetch_pdf(url, etag, last_modified)
+            if fetched == NOT_MODIFIED:
+                result = self.digests.get(digest) if digest else None
+                if result is not None:
+                    return result
+                fetched = self.fetch_pdf(url)
+
+            data, nb_pages, etag, last_modified = fetched
+            if not data:
+                return False
+
+            # only complete downloads (up to OABOT_PDF_MAX_BYTES) are
+            # identified by their digest: whether we only have the prefix
+            # of a linearized PDF depends on the server supporting ranges,
+            # so its digest would differ from one mirror to another
+            digest = hashlib.sha1(data).hexdigest() if nb_pages is None else None
+            result = self.digests.get(digest) if digest else None
+            if result is None:
+                if nb_pages is not None:
+                    print("num pages: %d" % nb_pages)
+                    result = nb_pages > 2
+                else:
+                    result = self.check_nb_pages(data)
+                    if result is TRANSIENT_FAILURE:
+                        # the parser pool did not answer: nothing to cache
+                        return result
+                if result and OABOT_CHECK_FULL_TEXT:
+                    if nb_pages is not None:
+                        # we only have the beginning of the file
+                        data = self.fetch_pdf(url, full=True)[0]
+                    result = bool(data) and self.looks_legit(data)
+                if digest:
+                    self.digests.set(digest, result)
+        except DeadlineExceeded:
+            raise
         except requests.exceptions.RequestException as e:
+            # including PdfReadTimeout: nothing is cached for this file
             print e
-            return False
+            return TRANSIENT_FAILURE
+
+        if etag or last_modified:
+            self.validators.set(url, (etag, last_modified, digest))
+        return result
+
+   def fetch_pdf(self, url, etag=None, last_modified=None, full=False):
+        """
+        Downloads a PDF file, returning a tuple: its contents (None
+        if it is not a PDF, possibly truncated to OABOT_PDF_MAX_BYTES),
+        its number of pages if it could be found without reading
+        the whole file (otherwise None), and its ETag and Last-Modified
+        headers. If validators are given and the file has not changed,
+        NOT_MODIFIED is returned instead.
+
+        We first ask for the beginning of the file only: if the server
+        supports range requests and the PDF is linearized, this is
+        enough to know its number of pages. With `full`, the whole
+        file is downloaded directly.
+        """
+        headers = {'User-Agent':OABOT_USER_AGENT}
+        if not full:
+            headers['Range'] = 'bytes=0-%d' % (OABOT_PDF_PROBE_BYTES-1)
+        conditional_headers = {}
+        if etag:
+            conditional_headers['If-None-Match'] = etag
+        if last_modified:
+            conditional_headers['If-Modified-Since'] = last_modified
+        headers.update(conditional_headers)
+
+        r = httpclient.get(url, headers=headers, verify=False, stream=True)
+        if r.status_code == 304:
+            r.close()
+            return NOT_MODIFIED
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        for header in conditional_headers:
+            del headers[header]
+
+        if r.status_code != 206:
+            # range requests not supported: read the full response
+            return self.read_pdf(r, 0), None, etag, last_modified
+
+        prefix = self.read_pdf(r, 0)
+        if not prefix:
+            return None, None, etag, last_modified
+        nb_pages = pdfpages.linearized_page_count(prefix)
+        if nb_pages is not None:
+            return prefix, nb_pages, etag, last_modified
+
+        headers['Range'] = 'bytes=%d-' % len(prefix)
+        r = httpclient.get(url, headers=headers, verify=False, stream=True)
+        if r.status_code == 206:
+            rest = self.read_pdf(r, len(prefix))
+            return prefix + (rest or b''), None, etag, last_modified
+        return self.read_pdf(r, 0), None, etag, last_modified
+
+   def read_pdf(self, r, offset):
+        """
+        Reads a streamed response, stopping after OABOT_PDF_MAX_BYTES
+        (counting the `offset` bytes already read). Returns None
+        if the response does not look like a PDF, and raises
+        PdfReadTimeout if it takes more than OABOT_PDF_READ_DEADLINE
+        seconds: the beginning of the file cannot be classified
+        as if it were the whole file.
+        """
+        try:
+            if r.status_code not in (200, 206):
+                return None
+            content_type = r.headers.get('Content-Type', '').lower()
+            if content_type.startswith('text/') or content_type.startswith('image/'):
+                return None
+
+            chunks = []
+            size = offset
+            checked = offset > 0
+            with ReadWatchdog(r, OABOT_PDF_READ_DEADLINE) as watchdog:
+                try:
+                    for chunk in r.iter_content(64*1024):
+                        chunks.append(chunk)
+                        size += len(chunk)
+                        if not checked and size >= 1024:
+                            # the PDF header should come first
+                            if pdf_magic not in b''.join(chunks)[:1024]:
+                                return None
+                            checked = True
+                        if size >= OABOT_PDF_MAX_BYTES:
+                            break
+                except (requests.exceptions.RequestException, socket.error):
+                    if not watchdog.expired:
+                        raise
+                if watchdog.expired:
+                    raise PdfReadTimeout('Reading the PDF took too long')
+
+            data = b''.join(chunks)
+            if not checked and pdf_magic not in data[:1024]:
+                return None
+            return data[:OABOT_PDF_MAX_BYTES - offset]
+        finally:
+            r.close()
 
    def check_nb_pages(self, data):
         """
-        Does this PDF contain enough pages?
+        Does this PDF contain enough pages? (TRANSIENT_FAILURE
+        if the parser pool could not tell)
+        """
+        enough_pages = pdfpages.more_pages_than(data, 2)
+        if enough_pages is not None:
+            return enough_pages
+        return self.check_nb_pages_pypdf(data)
+
+   def check_nb_pages_pypdf(self, data):
+        """
+        Same as check_nb_pages, with a full parse of the PDF
+        (in the worker processes of pdf_pool)
+        """
+        num_pages = pdf_pool.count_pages(data)
+        if num_pages is None:
+            return False
+        if num_pages is TRANSIENT_FAILURE:
+            return TRANSIENT_FAILURE
+        print("num pages: %d" % num_pages)
+        return num_pages > 2
+
+   def check_nb_pages_many(self, datas):
+        """
+        Same as check_nb_pages for a list of PDFs: the ones which
+        need a full parse are parsed in parallel.
+        """
+        results = [pdfpages.more_pages_than(data, 2) for data in datas]
+        to_parse = [idx for idx, result in enumerate(results) if result is None]
+        counts = pdf_pool.count_pages_many([datas[idx] for idx in to_parse])
+        for idx, num_pages in zip(to_parse, counts):
+            if num_pages is TRANSIENT_FAILURE:
+                results[idx] = TRANSIENT_FAILURE
+            else:
+                results[idx] = num_pages is not None and num_pages > 2
+        return results
+
+   def looks_legit(self, data):
+        """
+        Does this PDF look like a scholarly full text?
+        (only used when OABOT_CHECK_FULL_TEXT is set)
+
+        The text is extracted by PDFBox and classified by the
+        CiteSeerX filter, in the long-lived JVMs of jvm_pool.
         """
         try:
-            s_io = StringIO(data)
-            reader = PyPDF2.PdfFileReader(s_io)
-            num_pages = reader.getNumPages()
-            print("num pages: %d" % num_pages)
-            return num_pages > 2
-        except PyPdfError as e:
+            text, is_paper = jvm_pool.classify(data)
+            return is_paper
+        except WorkerError as e:
+            print e
             return False
 
    #######################################################
@@ -50,9 +293,9 @@ class AcademicPaperFilter(object):
     # Apache License 2.0
     # https://github.com/SeerLabs/new-csx-extractor
 
-   def looks_legit(self, data):
+   def looks_legit_one_shot(self, data):
         """
-        Does this PDF look like a scholarly full text?
+        Same as looks_legit, starting new JVMs for this document
         """
         # make a temporary directory for filter jar to read/write to
         temp_dir = tempfile.mkdtemp()
@@ -63,8 +306,7 @@ class AcademicPaperFilter(object):
             print e
             classifier_output = False
         finally:
-            #shutil.rmtree(temp_dir)
-            pass
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
         return classifier_output
 
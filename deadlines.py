@@ -0,0 +1,84 @@
+# -*- encoding: utf-8 -*-
+"""
+Time budgets for the processing of a page.
+
+A page gets a total budget, split across its citations as they are
+resolved. The deadline of the citation being resolved is attached to
+the current thread, and httpclient shortens the timeouts of outbound
+requests so that they do not run past it.
+"""
+from __future__ import unicode_literals
+import math
+import time
+import threading
+from contextlib import contextmanager
+import requests
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """
+    Raised when a request cannot be completed before the current deadline
+    """
+    pass
+
+class Deadline(object):
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds
+
+    def remaining(self):
+        return max(self.expires - time.time(), 0.)
+
+    def expired(self):
+        return time.time() >= self.expires
+
+class Budget(object):
+    """
+    A total time budget, shared by `nb_tasks` tasks run
+    `parallelism` at a time. Each task gets an equal share of
+    what remains when it starts (but at least `minimum` seconds,
+    unless the whole budget is exhausted).
+    """
+    def __init__(self, seconds, nb_tasks, parallelism=1, minimum=0):
+        self.deadline = Deadline(seconds)
+        self.nb_tasks = nb_tasks
+        self.parallelism = max(parallelism, 1)
+        self.minimum = minimum
+        self.lock = threading.Lock()
+
+    def next_deadline(self):
+        """
+        Returns the deadline of the next task
+        """
+        with self.lock:
+            remaining = self.deadline.remaining()
+            rounds = math.ceil(float(max(self.nb_tasks, 1)) / self.parallelism)
+            self.nb_tasks -= 1
+        share = max(remaining / rounds, self.minimum)
+        return Deadline(min(share, remaining))
+
+local = threading.local()
+
+def current_deadline():
+    """
+    The deadline of the current thread, or None
+    """
+    return getattr(local, 'deadline', None)
+
+@contextmanager
+def deadline_scope(deadline):
+    """
+    Attaches a deadline (possibly None) to the current thread
+    """
+    previous = current_deadline()
+    local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        local.deadline = previous
+
+def remaining_time():
+    """
+    Seconds left before the current deadline (None if there is none)
+    """
+    deadline = current_deadline()
+    if deadline is not None:
+        return deadline.remaining()
@@ -0,0 +1,124 @@
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.exceptions import ReadTimeoutError
+from settings import *
+from throttle import host_limiter, host_guard, host_of
+from deadlines import remaining_time, DeadlineExceeded
+
+class DeadlineAwareAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter which does not retry requests made under a deadline:
+    each retry would get the whole remaining time again.
+    """
+    no_retry = Retry(0, read=False)
+
+    @property
+    def max_retries(self):
+        if remaining_time() is not None:
+            return self.no_retry
+        return self.retries
+
+    @max_retries.setter
+    def max_retries(self, retries):
+        self.retries = retries
+
+def is_timeout(error):
+    """
+    Whether a requests exception is a timeout, including read timeouts
+    reported as connection errors once urllib3 has given up retrying
+    """
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    reason = error.args[0] if error.args else None
+    return isinstance(getattr(reason, 'reason', reason), ReadTimeoutError)
+
+class PooledSession(requests.Session):
+    """
+    A requests session shared by all the outbound calls of the bot.
+    It keeps connections alive in per-host pools, retries idempotent
+    requests on transient failures and applies a default timeout.
+    """
+    def __init__(self, timeout=OABOT_HTTP_TIMEOUT,
+                    pool_connections=OABOT_HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=OABOT_HTTP_POOL_MAXSIZE,
+                    retries=OABOT_HTTP_RETRIES,
+                    backoff=OABOT_HTTP_BACKOFF):
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+        retry = Retry(total=retries,
+                    backoff_factor=backoff,
+                    status_forcelist=[502, 503, 504],
+                    raise_on_status=False)
+        adapter = DeadlineAwareAdapter(pool_connections=pool_connections,
+                    pool_maxsize=pool_maxsize,
+                    max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.headers['User-Agent'] = OABOT_USER_AGENT
+
+    def request(self, method, url, **kwargs):
+        """
+        Same as requests.Session.request, with a default timeout
+        (shortened to fit in the deadline of the current thread),
+        the per-host concurrency limit and the circuit breakers
+        and rate limits of upstream APIs.
+        """
+        host = host_of(url)
+        host_guard.before_request(host, remaining_time())
+
+        timeout = kwargs.get('timeout')
+        if timeout is None:
+            timeout = self.timeout
+        remaining = remaining_time()
+        limited = False
+        if remaining is not None:
+            if remaining <= 0:
+                host_guard.cancel(host)
+                raise DeadlineExceeded('No time left to request %s' % url)
+            timeout, limited = fit_timeout(timeout, remaining)
+        kwargs['timeout'] = timeout
+
+        try:
+            with host_limiter.limit(url):
+                r = super(PooledSession, self).request(method, url, **kwargs)
+        except (requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError) as e:
+            if is_timeout(e) and limited:
+                # our deadline, not the host's fault
+                host_guard.cancel(host)
+                raise DeadlineExceeded('Deadline exceeded while requesting %s' % url)
+            host_guard.record(host, False)
+            if is_timeout(e) and not isinstance(e, requests.exceptions.Timeout):
+                raise requests.exceptions.ReadTimeout(e, request=e.request)
+            raise
+        except Exception:
+            host_guard.cancel(host)
+            raise
+        host_guard.record(host, r.status_code < 500)
+        return r
+
+def fit_timeout(timeout, remaining):
+    """
+    Shortens a requests timeout (a number or a (connect, read) tuple)
+    so that it does not exceed `remaining` seconds. Returns the new
+    timeout and whether it was shortened.
+    """
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return ((min(connect, remaining), min(read, remaining)),
+                remaining < max(connect, read))
+    return min(timeout, remaining), remaining < timeout
+
+session = PooledSession()
+
+def get(url, **kwargs):
+    return session.get(url, **kwargs)
+
+def post(url, **kwargs):
+    return session.post(url, **kwargs)
+
+def head(url, **kwargs):
+    return session.head(url, **kwargs)
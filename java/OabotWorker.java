@@ -0,0 +1,191 @@
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.util.jar.JarFile;
+
+import org.apache.pdfbox.pdmodel.PDDocument;
+import org.apache.pdfbox.text.PDFTextStripper;
+
+/**
+ * Long-lived worker used by jvmworker.py: it extracts the text of PDF
+ * files with PDFBox and runs the CiteSeerX paper filter on it, without
+ * starting a new JVM for each document.
+ *
+ * Usage:
+ *   java -cp pdfbox-app.jar:classifier.jar:java OabotWorker classifier.jar acl train.arff
+ *
+ * Requests (stdin): the length of the PDF as a 4-byte big-endian integer,
+ * followed by the PDF.
+ * Responses (stdout): a status byte ('T' for a paper, 'F' for something
+ * else, 'E' for an error), followed by two strings (the extracted text
+ * and the error message), each encoded in UTF-8 and prefixed by its length.
+ */
+public class OabotWorker {
+
+    private static volatile boolean exiting = false;
+
+    private static class ExitPrevented extends SecurityException {
+        ExitPrevented(int status) {
+            super("System.exit(" + status + ") called by the filter");
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        final Path workDir = Files.createTempDirectory("oabot-worker");
+        Files.copy(Paths.get(args[1]), workDir.resolve("acl"));
+        Files.copy(Paths.get(args[2]), workDir.resolve("train_str_f43_paper.arff"));
+        Runtime.getRuntime().addShutdownHook(new Thread() {
+            public void run() {
+                deleteRecursively(workDir.toFile());
+            }
+        });
+
+        String mainClass;
+        try (JarFile jar = new JarFile(args[0])) {
+            mainClass = jar.getManifest().getMainAttributes().getValue("Main-Class");
+        }
+        Method filterMain = Class.forName(mainClass).getMethod("main", String[].class);
+        preventExit();
+
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        DataOutputStream out = new DataOutputStream(new BufferedOutputStream(
+                new FileOutputStream(FileDescriptor.out)));
+        // stdout is reserved for responses
+        System.setOut(System.err);
+
+        while (true) {
+            int length;
+            try {
+                length = in.readInt();
+            } catch (EOFException e) {
+                break;
+            }
+            byte[] pdf = new byte[length];
+            in.readFully(pdf);
+
+            byte status;
+            String text = "";
+            String error = "";
+            try {
+                text = extractText(pdf);
+                status = (byte) (runFilter(filterMain, workDir, text) ? 'T' : 'F');
+            } catch (Throwable e) {
+                status = 'E';
+                error = String.valueOf(e);
+            }
+            out.writeByte(status);
+            writeString(out, text);
+            writeString(out, error);
+            out.flush();
+        }
+        exiting = true;
+    }
+
+    private static String extractText(byte[] pdf) throws IOException {
+        try (PDDocument document = PDDocument.load(pdf)) {
+            return new PDFTextStripper().getText(document);
+        }
+    }
+
+    private static boolean runFilter(Method filterMain, Path workDir, String text)
+            throws Exception {
+        Path textFile = workDir.resolve("file.txt");
+        Files.write(textFile, text.getBytes(StandardCharsets.UTF_8));
+
+        ByteArrayOutputStream captured = new ByteArrayOutputStream();
+        PrintStream previous = System.out;
+        System.setOut(new PrintStream(captured, true, "UTF-8"));
+        try {
+            filterMain.invoke(null, (Object) new String[] {
+                workDir.toString() + "/", "file", "paper" });
+        } catch (InvocationTargetException e) {
+            // exiting after printing the result is fine
+            if (!(e.getCause() instanceof ExitPrevented)) {
+                throw new Exception("Filter failed: " + e.getCause(), e.getCause());
+            }
+        } finally {
+            System.setOut(previous);
+            cleanWorkDir(workDir);
+        }
+
+        // the last line of output is "true" or "false"
+        String result = "";
+        for (String line : new String(captured.toByteArray(), StandardCharsets.UTF_8).split("\n")) {
+            if (!line.trim().isEmpty()) {
+                result = line.trim();
+            }
+        }
+        if (result.equalsIgnoreCase("true")) {
+            return true;
+        } else if (result.equalsIgnoreCase("false")) {
+            return false;
+        }
+        throw new Exception("Unexpected output from the filter: " + result);
+    }
+
+    private static void writeString(DataOutputStream out, String s) throws IOException {
+        byte[] bytes = s.getBytes(StandardCharsets.UTF_8);
+        out.writeInt(bytes.length);
+        out.write(bytes);
+    }
+
+    /**
+     * Removes the files written for a document, keeping the model files.
+     */
+    private static void cleanWorkDir(Path workDir) {
+        File[] files = workDir.toFile().listFiles();
+        if (files == null) {
+            return;
+        }
+        for (File file : files) {
+            String name = file.getName();
+            if (!name.equals("acl") && !name.equals("train_str_f43_paper.arff")) {
+                deleteRecursively(file);
+            }
+        }
+    }
+
+    private static void deleteRecursively(File file) {
+        File[] children = file.listFiles();
+        if (children != null) {
+            for (File child : children) {
+                deleteRecursively(child);
+            }
+        }
+        file.delete();
+    }
+
+    /**
+     * The filter is a command-line tool: stop it from exiting the JVM.
+     */
+    private static void preventExit() {
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                public void checkExit(int status) {
+                    if (!exiting) {
+                        throw new ExitPrevented(status);
+                    }
+                }
+
+                public void checkPermission(java.security.Permission permission) {
+                }
+            });
+        } catch (UnsupportedOperationException e) {
+            // security managers are disabled in recent JVMs
+        }
+    }
+}
@@ -0,0 +1,129 @@
+# -*- encoding: utf-8 -*-
+"""
+Background jobs processing pages for the web app.
+
+Processing an uncached page can take minutes: instead of holding
+the HTTP request, the page is processed in a background thread and
+the browser polls the job for the proposals found so far. There is
+at most one job per page at a time: requests for a page which is
+already being processed are attached to the running job.
+
+The state of the jobs and the edits they find are kept in the
+proposals database, so that the app can be served by several
+processes: any of them can answer the polls of a job, and a page
+requested in two processes is only processed once. The process
+running a job refreshes its heartbeat regularly: a job whose heartbeat
+is too old (because its process stopped) is reported as failed,
+and the page can be processed again.
+"""
+from __future__ import unicode_literals
+import time
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+from settings import *
+
+class Job(object):
+    """
+    The processing of one page in this process. `fun` is called with
+    the `args` and an `on_edit` keyword argument, a callback which
+    receives the proposed edits (as JSON dicts) as they are found.
+    It returns the final context of the page.
+    """
+    def __init__(self, store, job_id, fun, args):
+        self.store = store
+        self.id = job_id
+        self.fun = fun
+        self.args = args
+        self.sent = set()
+
+    def add_edit(self, edit):
+        self.sent.add(edit.get('orig_hash'))
+        self.store.add_job_edit(self.id, edit)
+
+    def add_remaining_edits(self, context):
+        """
+        Streams the edits of the final context which were not sent
+        through `on_edit` (for instance when they were already stored)
+        """
+        for edit in (context or {}).get('proposed_edits', []):
+            if edit.get('orig_hash') not in self.sent:
+                self.add_edit(edit)
+
+    def run(self):
+        self.store.update_job(self.id, 'running')
+        try:
+            context = self.fun(*self.args, on_edit=self.add_edit)
+            self.add_remaining_edits(context)
+            self.store.update_job(self.id, 'done', context=context)
+        except Exception as e:
+            traceback.print_exc()
+            self.store.update_job(self.id, 'failed',
+                    error='%s: %s' % (type(e).__name__, e))
+
+class JobManager(object):
+    """
+    Runs the jobs started by this process in a pool of `workers`
+    threads, refreshing their heartbeat every `heartbeat` seconds.
+    Finished jobs are kept in `store` for `retention` seconds,
+    so that their results can be polled.
+    """
+    def __init__(self, store, workers=OABOT_JOB_WORKERS,
+                    retention=OABOT_JOB_RETENTION,
+                    heartbeat=OABOT_JOB_HEARTBEAT):
+        self.store = store
+        self.workers = workers
+        self.retention = retention
+        self.heartbeat = heartbeat
+        self.running = set()
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def stale_before(self):
+        """
+        Jobs whose heartbeat is older than this are considered lost
+        """
+        return time.time() - 3 * self.heartbeat
+
+    def submit(self, key, fun, *args):
+        """
+        Starts a job for `key` (unless one is already running, in any
+        process, in which case it is attached to) and returns its id
+        """
+        self.store.forget_jobs(time.time() - self.retention)
+        job_id, created = self.store.start_job(key, self.stale_before())
+        if created:
+            job = Job(self.store, job_id, fun, args)
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ThreadPool(self.workers)
+                    beat = threading.Thread(target=self.beat)
+                    beat.daemon = True
+                    beat.start()
+                self.running.add(job_id)
+            self.pool.apply_async(self.run, (job,))
+        return job_id
+
+    def run(self, job):
+        try:
+            job.run()
+        finally:
+            with self.lock:
+                self.running.discard(job.id)
+
+    def beat(self):
+        while True:
+            time.sleep(self.heartbeat)
+            with self.lock:
+                running = list(self.running)
+            try:
+                self.store.touch_jobs(running)
+            except Exception:
+                traceback.print_exc()
+
+    def progress(self, job_id, since=0):
+        """
+        The state of a job and the edits found after the first `since`
+        (None if the job is unknown)
+        """
+        return self.store.job_progress(job_id, since, self.stale_before())
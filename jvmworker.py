@@ -0,0 +1,196 @@
+# -*- encoding: utf-8 -*-
+"""
+Pool of long-lived JVMs running java/OabotWorker, which extracts the
+text of PDF files with PDFBox and runs the CiteSeerX paper filter on it.
+Starting a JVM takes longer than classifying a document, so workers
+are kept running and fed one PDF after another through their stdin.
+"""
+from __future__ import unicode_literals
+import os
+import time
+import errno
+import select
+import struct
+import threading
+import subprocess32 as subprocess
+from settings import *
+
+WORKER_SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'java')
+
+class WorkerError(Exception):
+    pass
+
+def worker_classpath():
+    return os.pathsep.join([PDFBOX_JAR_PATH, FILTER_JAR_PATH, WORKER_SOURCE_DIR])
+
+def compile_worker():
+    """
+    Compiles OabotWorker.java if it has not been compiled yet
+    """
+    class_file = os.path.join(WORKER_SOURCE_DIR, 'OabotWorker.class')
+    if os.path.isfile(class_file):
+        return
+    try:
+        status = subprocess.call(['javac', '-cp', worker_classpath(),
+                    os.path.join(WORKER_SOURCE_DIR, 'OabotWorker.java')])
+    except OSError as e:
+        raise WorkerError('Could not run javac: %s' % e)
+    if status != 0:
+        raise WorkerError('Could not compile OabotWorker.java')
+
+class JvmWorker(object):
+    """
+    One JVM process, handling one document at a time
+    """
+    def __init__(self):
+        compile_worker()
+        try:
+            self.process = subprocess.Popen(
+                ['java', '-Xmx%dm' % OABOT_JVM_HEAP_MB,
+                 '-cp', worker_classpath(), 'OabotWorker',
+                 FILTER_JAR_PATH, FILTER_ACL_PATH, FILTER_TRAIN_DATA_PATH],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL)
+        except OSError as e:
+            raise WorkerError('Could not start the JVM worker: %s' % e)
+        self.nb_documents = 0
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+    def close(self):
+        """
+        Closing stdin lets the worker exit (and remove its temporary files)
+        """
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (IOError, subprocess.TimeoutExpired):
+            self.kill()
+
+    def read_exactly(self, n, deadline):
+        fd = self.process.stdout.fileno()
+        chunks = []
+        while n > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise WorkerError('JVM worker timed out')
+            try:
+                ready, _, _ = select.select([fd], [], [], remaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+            chunk = os.read(fd, n)
+            if not chunk:
+                raise WorkerError('JVM worker exited')
+            chunks.append(chunk)
+            n -= len(chunk)
+        return b''.join(chunks)
+
+    def read_string(self, deadline):
+        length = struct.unpack(str('>I'), self.read_exactly(4, deadline))[0]
+        return self.read_exactly(length, deadline).decode('utf-8')
+
+    def classify(self, data, timeout):
+        """
+        Sends a PDF to the worker and returns its response: a tuple
+        of the status ('T', 'F' or 'E'), the text and the error message
+        """
+        self.nb_documents += 1
+        try:
+            self.process.stdin.write(struct.pack(str('>I'), len(data)))
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except IOError as e:
+            raise WorkerError('Could not send the document to the JVM worker: %s' % e)
+
+        deadline = time.time() + timeout
+        status = self.read_exactly(1, deadline)
+        text = self.read_string(deadline)
+        error = self.read_string(deadline)
+        return status, text, error
+
+class JvmWorkerPool(object):
+    """
+    Hands documents to up to `size` JVM workers, started on demand.
+    Workers which time out or fail are killed and replaced, and each
+    worker is recycled after `documents_per_worker` documents.
+    """
+    def __init__(self, size=OABOT_JVM_WORKERS,
+                    timeout=OABOT_JVM_TIMEOUT,
+                    documents_per_worker=OABOT_JVM_DOCUMENTS_PER_WORKER):
+        self.size = size
+        self.timeout = timeout
+        self.documents_per_worker = documents_per_worker
+        self.idle = []
+        self.nb_workers = 0
+        # notified when a worker becomes idle or one can be started
+        self.available = threading.Condition()
+
+    def acquire(self):
+        with self.available:
+            while not self.idle and self.nb_workers >= self.size:
+                self.available.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.nb_workers += 1
+        try:
+            return JvmWorker()
+        except:
+            self.forget_worker()
+            raise
+
+    def forget_worker(self):
+        """
+        Records that a worker has stopped, so that another can be started
+        """
+        with self.available:
+            self.nb_workers -= 1
+            self.available.notify()
+
+    def release(self, worker, healthy):
+        if healthy and worker.alive() and worker.nb_documents < self.documents_per_worker:
+            with self.available:
+                self.idle.append(worker)
+                self.available.notify()
+            return
+        if healthy:
+            worker.close()
+        else:
+            worker.kill()
+        self.forget_worker()
+
+    def classify(self, data):
+        """
+        Returns the text of a PDF and whether it looks like a paper.
+        Raises WorkerError if it could not be processed.
+        """
+        worker = self.acquire()
+        healthy = False
+        try:
+            status, text, error = worker.classify(data, self.timeout)
+            # the worker has answered: it can process other documents
+            healthy = True
+        finally:
+            self.release(worker, healthy)
+        if status == b'E':
+            raise WorkerError(error)
+        return text, status == b'T'
+
+    def close(self):
+        with self.available:
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.close()
+            self.forget_worker()
+
+jvm_pool = JvmWorkerPool()
@@ -4,25 +4,63 @@ from wikiciteparser.parser import parse_citation_template
 from urllib import urlencode
 import mwparserfromhell
 import requests
+import httpclient
 import json
 import codecs
 import sys
 import urllib
 from unidecode import unidecode
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 from copy import deepcopy
 import os
 from arguments import template_arg_mappings, get_value
-from ranking import sort_links
+from ranking import sort_links, DomainStats
+from urlnorm import canonical_url, dedupe_urls
 from settings import *
-from ondiskcache import OnDiskCache
+from ondiskcache import OnDiskCache, TRANSIENT_FAILURE, outcome_ttl, LRUStore
 from classifier import AcademicPaperFilter
+import probe
+from proposals import ProposalStore
+from multiprocessing.pool import ThreadPool
+from functools import partial
+from deadlines import Budget, DeadlineExceeded, deadline_scope, current_deadline
+from throttle import HostUnavailable, host_of
 import md5
-
-urls_cache = OnDiskCache('urls_cache.pkl')
+import time
+import threading
+
+urls_cache = OnDiskCache('urls_cache.sqlite', migrate_from='urls_cache.pkl',
+            snapshot='urls_cache.snapshot',
+            key_function=canonical_url,
+            ttl_policy=outcome_ttl(
+                positive=timedelta(days=OABOT_CACHE_TTL_FREE),
+                negative=timedelta(days=OABOT_CACHE_TTL_NOT_FREE),
+                transient=timedelta(days=OABOT_CACHE_TTL_TRANSIENT)),
+            capacity=OABOT_CACHE_CAPACITY)
+oa_links_cache = OnDiskCache('oa_links_cache.sqlite', migrate_from='oa_links_cache.pkl',
+            ttl_policy=outcome_ttl(
+                positive=timedelta(days=OABOT_RESOLUTION_CACHE_TTL),
+                negative=timedelta(days=OABOT_RESOLUTION_CACHE_TTL),
+                transient=timedelta(days=OABOT_CACHE_TTL_TRANSIENT)),
+            capacity=OABOT_CACHE_CAPACITY)
+# per-domain hit rates and latencies of the free-to-read checks
+domain_stats_cache = OnDiskCache('domain_stats.sqlite',
+            ttl=timedelta(days=OABOT_DOMAIN_STATS_TTL))
+domain_stats = DomainStats(domain_stats_cache)
+urls_cache.start_flushing(OABOT_CACHE_FLUSH_INTERVAL, OABOT_CACHE_FLUSH_BATCH)
+oa_links_cache.start_flushing(OABOT_CACHE_FLUSH_INTERVAL, OABOT_CACHE_FLUSH_BATCH)
+domain_stats_cache.start_flushing(OABOT_CACHE_FLUSH_INTERVAL, OABOT_CACHE_FLUSH_BATCH)
 paper_filter = AcademicPaperFilter()
-
+proposal_store = ProposalStore(OABOT_PROPOSALS_DB)
+# recently fetched pages, keyed by (title, revid): (time fetched, page)
+wikitext_cache = LRUStore(OABOT_WIKITEXT_CACHE_SIZE)
+# how far check_free_to_read went for the URLs it checked
+check_counts = probe.StageCounter()
+
+doi_prefix_re = re.compile(r'^\s*(doi:|https?://(dx\.)?doi\.org/)\s*', re.IGNORECASE)
+non_alphanumeric_re = re.compile(r'[^a-z0-9]+')
+year_re = re.compile(r'\b(1[0-9]{3}|20[0-9]{2})\b')
 rg_re = re.compile('(https?://www\.researchgate\.net/)(.*)(publication/[0-9]*)_.*/links/[0-9a-f]*.pdf')
 
 
@@ -47,6 +85,8 @@ class TemplateEdit(object):
         self.proposed_link = None
         self.index = None
         self.page = page
+        # the upstream host which prevented us from resolving the citation
+        self.unavailable_host = None
 
     def json(self):
         return {
@@ -100,7 +140,16 @@ class TemplateEdit(object):
             # return
 
         # Otherwise, try to get a free link
-        link = get_oa_link(reference)
+        try:
+            link = get_oa_link(reference)
+        except DeadlineExceeded:
+            self.classification = 'timed_out'
+            return
+        except requests.exceptions.RequestException as e:
+            self.classification = 'host_unavailable'
+            self.unavailable_host = getattr(e, 'host', None) or (
+                host_of(e.request.url) if e.request is not None else None)
+            return
         if not link:
             self.classification = 'not_found'
             return
@@ -155,10 +204,79 @@ class TemplateEdit(object):
 def remove_diacritics(s):
     return unidecode(s) if type(s) == unicode else s
 
+def normalize_doi(doi):
+    """
+    Strips resolver prefixes from a DOI and lowercases it
+    (DOIs are case-insensitive)
+    """
+    if not doi:
+        return None
+    return doi_prefix_re.sub('', doi).strip().lower() or None
+
+def normalize_text(s):
+    """
+    Lowercases a string and reduces it to ascii words
+    """
+    s = remove_diacritics(s or '').lower()
+    return non_alphanumeric_re.sub(' ', s).strip()
+
+def resolution_key(reference):
+    """
+    Key under which the OA link of a reference is cached:
+    its normalized DOI, or otherwise its normalized title,
+    year and first author's last name. Returns None for
+    references which cannot be identified reliably (no DOI,
+    and no title with a year or an author).
+    """
+    doi = normalize_doi(reference.get('ID_list', {}).get('DOI'))
+    if doi:
+        return 'doi:'+doi
+
+    title = normalize_text(reference.get('Title'))
+    if not title:
+        return None
+
+    year_match = year_re.search(reference.get('Date') or '')
+    year = year_match.group(1) if year_match else ''
+
+    first_author = ''
+    authors = reference.get('Authors') or []
+    if authors:
+        name = authors[0].get('last') or authors[0].get('plain')
+        # for unparsed names ('First Last'), keep the last word only
+        words = normalize_text(name).split()
+        first_author = words[-1] if words else ''
+
+    if not year and not first_author:
+        # generic titles ('Introduction', 'Annual report'…) would
+        # share the same key
+        return None
+    return 'title:%s|%s|%s' % (title, year, first_author)
+
 def get_oa_link(reference):
     """
     Given a citation template (as parsed by wikiciteparser),
     return a link to a full text for this citation (or None).
+
+    Results (including negative ones) are cached by resolution_key.
+    """
+    key = resolution_key(reference)
+    cached_link = oa_links_cache.get(key) if key else None
+    if cached_link is not None:
+        return cached_link or None
+
+    link = find_oa_link(reference)
+    if key:
+        # False records that no link could be found, TRANSIENT_FAILURE
+        # that some candidate could not be checked (kept for less time)
+        oa_links_cache.set(key, link if link is not None else False)
+    return link or None
+
+def find_oa_link(reference):
+    """
+    Queries Dissemin and oaDOI to find a link to a full text
+    for a citation. If none is found, returns None, or
+    TRANSIENT_FAILURE if some candidate could not be checked.
     """
     doi = reference.get('ID_list', {}).get('DOI')
     title = reference.get('Title')
@@ -183,7 +301,7 @@ def get_oa_link(reference):
     # (rationale: dissemin returns links that are easier
     # to convert to identifiers (DOI, HDL) so it gives cleaner
     # template outputs)
-    req = requests.post('https://dissem.in/api/query',
+    req = httpclient.post('https://dissem.in/api/query',
                         json=args,
                         headers={'User-Agent':OABOT_USER_AGENT})
 
@@ -203,21 +321,24 @@ def get_oa_link(reference):
     # we can check availability manually:
 
     oa_url = None
-    candidate_urls = sort_links([
+    # several records often point to the same page. The most
+    # promising ones (given the past checks on their domain) come first
+    candidate_urls = dedupe_urls(sort_links([
         record.get('splash_url') for record in
         paper_object.get('records',[])
-    ])
-    for url in sort_links(candidate_urls):
-        is_free = check_free_to_read(url)
-        if is_free:
-            # If we found a free URL, we are happy!
-	    return url
+        if record.get('splash_url')
+    ], domain_stats))
+    url, transient = first_free_url(candidate_urls)
+    if url:
+        # If we found a free URL, we are happy!
+        return url
 
     # then, try OAdoi
     # (OAdoi finds full texts that dissemin does not, so it's always good to have!)
     if doi:
         email = '{}@{}.in'.format('contact', 'dissem')
-        req = requests.get('https://api.oadoi.org/v2/:{}'.format(doi), {'email':email})
+        req = httpclient.get('https://api.oadoi.org/v2/:{}'.format(doi),
+                        params={'email':email})
         print(req.url)
         resp = req.json()
         best_oa = (resp.get('best_oa_location') or {})
@@ -226,14 +347,110 @@ def get_oa_link(reference):
         if best_oa.get('url'):
             return best_oa['url']
 
+    if transient:
+        return TRANSIENT_FAILURE
+
+# threads checking candidate URLs speculatively, shared by all citations
+probe_pool = None
+probe_pool_lock = threading.Lock()
+
+def get_probe_pool():
+    global probe_pool
+    with probe_pool_lock:
+        if probe_pool is None:
+            probe_pool = ThreadPool(max(OABOT_RESOLUTION_WORKERS, 1) *
+                            OABOT_SPECULATIVE_PROBES)
+        return probe_pool
+
+def speculative_check(url, cancelled, deadline):
+    """
+    Checks a candidate URL (within the deadline of the citation),
+    unless the answer was settled before the check started
+    """
+    if cancelled.is_set():
+        return None
+    with deadline_scope(deadline):
+        return check_free_to_read(url)
+
+def first_free_url(urls, window=None):
+    """
+    Returns the first URL of a ranked list which is free to read
+    (or None), and whether some checks could not be completed.
+
+    Up to `window` (OABOT_SPECULATIVE_PROBES by default) URLs are
+    checked at the same time, but the rank order is kept: a free URL
+    is only returned once all the URLs ranked before it are known
+    not to be free. Checks which have not started yet when the
+    answer is settled are cancelled.
+    """
+    if window is None:
+        window = OABOT_SPECULATIVE_PROBES
+    transient = False
+    if window <= 1 or len(urls) <= 1:
+        for url in urls:
+            is_free = check_free_to_read(url)
+            if is_free:
+                return url, transient
+            transient = transient or is_free is TRANSIENT_FAILURE
+        return None, transient
+
+    pool = get_probe_pool()
+    cancelled = threading.Event()
+    pending = []
+    remaining = list(urls)
+    try:
+        while pending or remaining:
+            # no need to start a new check if the next result is known
+            while (remaining and len(pending) < window and
+                    not (pending and pending[0][1].ready())):
+                url = remaining.pop(0)
+                pending.append((url, pool.apply_async(speculative_check,
+                    (url, cancelled, current_deadline()))))
+            url, result = pending.pop(0)
+            is_free = result.get()
+            if is_free:
+                return url, transient
+            transient = transient or is_free is TRANSIENT_FAILURE
+        return None, transient
+    finally:
+        cancelled.set()
+
 @urls_cache.cached
 def check_free_to_read(url):
     """
     Checks (with Zotero translators and CiteSeerX
-    paper filters) that a given URL is free to read
+    paper filters) that a given URL is free to read.
+    Returns TRANSIENT_FAILURE (which is falsy) when
+    the check could not be completed.
+
+    The outcome and duration of the check are recorded
+    in the statistics of the domain, used to rank links.
+    """
+    start = time.time()
+    is_free = check_url(url)
+    domain_stats.record(url,
+            None if is_free is TRANSIENT_FAILURE else bool(is_free),
+            time.time() - start)
+    return is_free
+
+def check_url(url):
+    """
+    Uncached version of check_free_to_read.
+
+    The URL is probed first: dead links and paywalls are
+    discarded and direct links to PDF files are classified
+    without going through Zotero.
     """
     try:
-            r = requests.post('http://doi-cache.dissem.in/zotero/query',
+            probed = probe.probe_url(url)
+            check_counts.count('probe_' + probed.outcome)
+            if probed.outcome in (probe.DEAD, probe.PAYWALLED, probe.NOT_A_PAGE):
+                return False
+            elif probed.outcome == probe.PDF:
+                return paper_filter.classify_url(probed.url)
+
+            check_counts.count('zotero')
+            r = httpclient.post('http://doi-cache.dissem.in/zotero/query',
                         data={
                     'url':url,
                     'key':ZOTERO_CACHE_API_KEY,
@@ -249,6 +466,8 @@ def check_free_to_read(url):
             except ValueError:
                 if r.status_code == 403:
                     raise ValueError("Please provide a valid Zotero cache API key")
+                elif r.status_code >= 500:
+                    return TRANSIENT_FAILURE
             if not items:
                 return False
 
@@ -262,42 +481,231 @@ def check_free_to_read(url):
                         return paper_filter.classify_url(attachment.get('url'))
                     elif attachment.get('title') == 'PubMed Central Link':
                         return True
-    except requests.exceptions.Timeout:
-        pass
+    except (DeadlineExceeded, HostUnavailable):
+        # not a property of the URL: do not cache it
+        raise
+    except (requests.exceptions.TooManyRedirects,
+            requests.exceptions.InvalidSchema,
+            requests.exceptions.MissingSchema,
+            requests.exceptions.InvalidURL):
+        # redirect loops, links to ftp:// or malformed URLs:
+        # the URL itself is the problem
+        check_counts.count('invalid_url')
+        return False
+    except requests.exceptions.RequestException:
+        # timeouts, connection errors, truncated responses…
+        check_counts.count('transient_failure')
+        return TRANSIENT_FAILURE
     return False
 
 
-def add_oa_links_in_references(text, page):
+def resolve_template_edit(edit, budget=None):
+    """
+    Proposes a change for a template edit and returns it
+    (used as a worker function by the resolution pool),
+    within its share of the time budget of the page
+    """
+    deadline = budget.next_deadline() if budget else None
+    with deadline_scope(deadline):
+        edit.propose_change()
+    return edit
+
+def add_oa_links_in_references(text, page, workers=None, budget=None):
     """
     Main function of the bot.
 
     :param text: the wikicode of the page to edit
-    :returns: a tuple: the new wikicode, the list of changed templates,
-            and edit statistics
+    :param workers: the number of templates to resolve in parallel
+            (defaults to OABOT_RESOLUTION_WORKERS)
+    :param budget: the time (in seconds) we can spend resolving
+            the templates (defaults to OABOT_PAGE_BUDGET). Templates
+            which cannot be resolved in time are classified as 'timed_out'.
+    :returns: a generator of TemplateEdit objects, in the order
+            in which the templates appear in the page
     """
     wikicode = mwparserfromhell.parse(text)
+    if workers is None:
+        workers = OABOT_RESOLUTION_WORKERS
 
+    edits = []
     for index, template in enumerate(wikicode.filter_templates()):
         edit = TemplateEdit(template, page)
         edit.index = index
-        edit.propose_change()
-        yield edit
+        edits.append(edit)
 
-def get_page_over_api(page_name):
-    r = requests.get('https://en.wikipedia.org/w/api.php', params={
+    budget = Budget(budget or OABOT_PAGE_BUDGET, len(edits),
+                    parallelism=min(workers, len(edits)),
+                    minimum=OABOT_CITATION_MIN_BUDGET)
+
+    if workers <= 1 or len(edits) <= 1:
+        for edit in edits:
+            yield resolve_template_edit(edit, budget)
+        return
+
+    # imap hands back results in submission order, so the edits
+    # are still yielded by increasing index
+    pool = ThreadPool(min(workers, len(edits)))
+    try:
+        for edit in pool.imap(partial(resolve_template_edit, budget=budget), edits):
+            yield edit
+    finally:
+        pool.terminate()
+
+def resolve_title(title, mappings):
+    """
+    Follows the title normalizations and redirects
+    reported by the API, starting from a requested title
+    """
+    seen = set()
+    while title in mappings and title not in seen:
+        seen.add(title)
+        title = mappings[title]
+    return title
+
+def fetch_page_batch(titles, follow_redirects=True):
+    """
+    Fetches the latest revision of up to OABOT_WIKI_API_BATCH pages
+    in one query (plus continuations, when the API does not return
+    all the contents at once). Returns a dict mapping each requested
+    title to the page (see get_pages_over_api), or None if it
+    does not exist.
+    """
+    params = {
+        'action':'query',
+        'titles':'|'.join(titles),
+        'prop':'revisions|pageviews',
+        'rvprop':'ids|timestamp|content',
+        'pvipdays':30,
+        'format':'json',
+        'continue':'',
+    }
+    if follow_redirects:
+        params['redirects'] = 1
+
+    mappings = {}
+    pages = {}
+    pageviews = {}
+    while True:
+        r = httpclient.get('https://en.wikipedia.org/w/api.php', params=params,
+                headers={'User-Agent':OABOT_USER_AGENT})
+        js = r.json()
+        query = js.get('query', {})
+        for mapping in query.get('normalized', []) + query.get('redirects', []):
+            mappings[mapping['from']] = mapping['to']
+        for page in query.get('pages', {}).values():
+            if page.get('pageviews'):
+                pageviews[page.get('title')] = sum(
+                    views or 0 for views in page['pageviews'].values())
+            revisions = page.get('revisions')
+            if page.get('pageid', -1) == -1 or not revisions:
+                # missing page, or contents in a continuation
+                continue
+            pages[page['title']] = {
+                'title': page['title'],
+                'pageid': page['pageid'],
+                'revid': revisions[0].get('revid'),
+                'timestamp': revisions[0].get('timestamp'),
+                'text': revisions[0]['*'],
+            }
+        if 'continue' not in js:
+            break
+        params.update(js['continue'])
+
+    now = time.time()
+    for title, page in pages.items():
+        page['pageviews'] = pageviews.get(title, 0)
+        wikitext_cache[(title, page['revid'])] = (now, page)
+    return dict((title, pages.get(resolve_title(title, mappings)))
+                for title in titles)
+
+def iter_pages_over_api(titles, follow_redirects=True):
+    """
+    Same as get_pages_over_api, yielding (requested title, page)
+    pairs batch by batch, so that long lists of titles can be
+    processed without holding all the pages in memory.
+    """
+    batch = []
+    for title in titles:
+        if title not in batch:
+            batch.append(title)
+        if len(batch) == OABOT_WIKI_API_BATCH:
+            for pair in fetch_page_batch(batch, follow_redirects).items():
+                yield pair
+            batch = []
+    if batch:
+        for pair in fetch_page_batch(batch, follow_redirects).items():
+            yield pair
+
+def get_pages_over_api(titles, follow_redirects=True):
+    """
+    Fetches the latest revision of several pages, making one query
+    for every OABOT_WIKI_API_BATCH titles. Titles are normalized and
+    (if follow_redirects is set) redirects are followed by the API.
+
+    :returns: a dict mapping each requested title to None if the page
+        does not exist, or to a dict with the 'title' of the page
+        (after normalization and redirects), its 'pageid', the 'revid'
+        and 'timestamp' of its latest revision, its 'text' and its
+        number of 'pageviews' in the last 30 days.
+    """
+    return dict(iter_pages_over_api(titles, follow_redirects))
+
+def get_page_info_over_api(page_name, follow_redirects=True):
+    """
+    Returns the 'title', 'pageid' and latest 'revid' of a page
+    (with prop=info, which does not download its contents).
+    Raises ValueError if it does not exist.
+    """
+    params = {
         'action':'query',
         'titles':page_name,
-        'prop':'revisions',
-        'rvprop':'content',
-        'format':'json',},
-        headers={'User-Agent':OABOT_USER_AGENT})
-    js = r.json()
-    page = js.get('query',{}).get('pages',{}).values()[0]
-    pagid = page.get('pageid', -1)
-    if pagid == -1:
+        'prop':'info',
+        'format':'json',
+    }
+    if follow_redirects:
+        params['redirects'] = 1
+    r = httpclient.get('https://en.wikipedia.org/w/api.php', params=params,
+            headers={'User-Agent':OABOT_USER_AGENT})
+    query = r.json().get('query', {})
+    mappings = {}
+    for mapping in query.get('normalized', []) + query.get('redirects', []):
+        mappings[mapping['from']] = mapping['to']
+    title = resolve_title(page_name, mappings)
+    for page in query.get('pages', {}).values():
+        if page.get('title') == title and page.get('pageid', -1) != -1:
+            return {
+                'title': page['title'],
+                'pageid': page['pageid'],
+                'revid': page.get('lastrevid'),
+            }
+    raise ValueError("Invalid page.")
+
+def get_page(page_name, follow_redirects=True, info=None):
+    """
+    Returns the latest revision of a page (see get_pages_over_api).
+    The contents of recently fetched revisions are kept for
+    OABOT_WIKITEXT_CACHE_TTL seconds: if the page has not changed,
+    this only costs a revision check.
+
+    :param info: the result of get_page_info_over_api for this page,
+        if it is already known
+    """
+    if info is None:
+        info = get_page_info_over_api(page_name, follow_redirects)
+    cached = wikitext_cache.get((info['title'], info['revid']))
+    if cached and time.time() - cached[0] < OABOT_WIKITEXT_CACHE_TTL:
+        return cached[1]
+    page = get_pages_over_api([page_name], follow_redirects)[page_name]
+    if page is None:
         raise ValueError("Invalid page.")
-    text = page.get('revisions',[{}])[0]['*']
-    return text
+    return page
+
+def get_page_over_api(page_name):
+    """
+    Returns the wikicode of a page (without following redirects).
+    Raises ValueError if it does not exist.
+    """
+    return get_page(page_name, follow_redirects=False)['text']
 
 def bot_is_allowed(text, user):
     """
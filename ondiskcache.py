@@ -2,67 +2,620 @@
 from __future__ import unicode_literals
 import datetime
 import cPickle
-from os.path import isfile
+import sqlite3
+import threading
+import tempfile
+import atexit
+import os
+from collections import OrderedDict, Counter
+from os.path import isfile, dirname, abspath
+from snapshot import CacheSnapshot, write_snapshot
+from ranking import extract_domain
 
-class OnDiskCache(object):
+class TransientFailure(object):
+    """
+    Falsy value cached when a check could not be completed
+    (timeout, connection error…), so that it can be given
+    a shorter TTL than a real negative answer.
+    """
+    def __nonzero__(self):
+        return False
+
+    def __repr__(self):
+        return 'TRANSIENT_FAILURE'
+
+    def __reduce__(self):
+        # unpickle to the module-level singleton
+        return str('TRANSIENT_FAILURE')
+
+TRANSIENT_FAILURE = TransientFailure()
+
+def outcome_ttl(positive, negative, transient):
+    """
+    Builds a TTL policy for OnDiskCache which depends on
+    the value stored: positive (truthy) results, negative
+    results and transient failures get their own TTL.
+    """
+    def policy(value):
+        if value is TRANSIENT_FAILURE:
+            return transient
+        return positive if value else negative
+    return policy
+
+class LRUStore(object):
+    """
+    In-memory mapping holding at most `capacity` entries:
+    when it is full, the least recently used entry is evicted.
+    """
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            # move it to the most recently used end
+            self.entries[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while self.capacity and len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.entries[key]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+class PickleBackend(object):
+    """
+    Stores the whole cache as a single pickled dict
+    mapping keys to (date, value) pairs.
+    """
     def __init__(self, path):
         self.path = path
-        self.store = {}
-        self.ttl = datetime.timedelta(days=365)
-        if path:
-            self.load()
+        self.entries = None
 
     def load(self):
+        if self.entries is None:
+            self.entries = self.read()
+        return self.entries
+
+    def read(self):
         if isfile(self.path):
             with open(self.path, 'rb') as f:
-                self.store = cPickle.load(f)
-        else:
-            self.store = {}
-            with open(self.path, 'wb') as f:
-                cPickle.dump(self.store, f)
+                return cPickle.load(f)
+        with open(self.path, 'wb') as f:
+            cPickle.dump({}, f)
+        return {}
+
+    def get(self, key):
+        return self.load().get(key)
+
+    def iteritems(self):
+        return self.load().iteritems()
+
+    def write(self, entries, ttl_for):
+        """
+        Merges the entries with the current contents of the file
+        (which may have been updated by other processes), prunes
+        expired entries and rewrites the file.
+        """
+        store = self.read()
+        store.update(entries)
+        self.entries = store
+        self.prune(ttl_for)
+        self.write_file(self.entries)
+
+    def write_file(self, store):
+        # write to a temporary file which replaces the cache
+        # atomically, so that a crash never leaves a truncated pickle
+        f = tempfile.NamedTemporaryFile(dir=dirname(abspath(self.path)),
+                    prefix='.tmp-', delete=False)
+        try:
+            with f:
+                cPickle.dump(store, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(f.name, self.path)
+        except:
+            os.remove(f.name)
+            raise
+
+    def prune(self, ttl_for):
+        today = datetime.date.today()
+        store = self.load()
+        for k in list(store.keys()):
+            d, v = store[k]
+            if d + ttl_for(v) <= today:
+                del store[k]
+
+    def compact(self, ttl_for, key_function=None):
+        """
+        Prunes expired entries, merges the entries whose keys are
+        equivalent under key_function (keeping the most recent one)
+        and rewrites the file.
+        """
+        store = self.read()
+        if key_function:
+            merged = {}
+            for k, (d, v) in store.iteritems():
+                canonical = key_function(k)
+                current = merged.get(canonical)
+                if current is None or current[0] < d:
+                    merged[canonical] = (d, v)
+            store = merged
+        self.entries = store
+        self.prune(ttl_for)
+        self.write_file(self.entries)
+
+class SqliteBackend(object):
+    """
+    Stores the cache in a SQLite table indexed by key, so that
+    lookups and writes do not need to load the whole cache.
+    The database is opened in WAL mode, which lets several
+    processes read and write it concurrently.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30,
+                    check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                    'key TEXT PRIMARY KEY, '
+                    'day INTEGER NOT NULL, '
+                    'expires INTEGER NOT NULL, '
+                    'value BLOB NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_expires '
+                    'ON entries (expires)')
+
+    def load(self):
+        pass
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT day, value FROM entries WHERE key = ?',
+                (key,)).fetchone()
+        if row:
+            return self.decode(row[0], row[1])
+
+    def decode(self, day, value):
+        return (datetime.date.fromordinal(day), cPickle.loads(bytes(value)))
+
+    def encode(self, key, entry, ttl_for):
+        d, v = entry
+        return (key, d.toordinal(), (d + ttl_for(v)).toordinal(),
+                sqlite3.Binary(cPickle.dumps(v, cPickle.HIGHEST_PROTOCOL)))
+
+    def iteritems(self):
+        """
+        Iterates over the entries without loading all of them in memory
+        (this uses its own connection, so that other operations
+        can go on meanwhile)
+        """
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            for key, day, value in conn.execute(
+                    'SELECT key, day, value FROM entries'):
+                yield key, self.decode(day, value)
+        finally:
+            conn.close()
 
-    def fresh(self, date):
-        return date+self.ttl > datetime.date.today()
+    def write(self, entries, ttl_for, replace=True):
+        """
+        Writes the given entries in a single transaction.
+        """
+        verb = 'REPLACE' if replace else 'IGNORE'
+        rows = [self.encode(k, e, ttl_for) for k, e in entries.iteritems()]
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany(
+                    'INSERT OR %s INTO entries VALUES (?, ?, ?, ?)' % verb,
+                    rows)
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def prune(self, ttl_for):
+        with self.lock:
+            self.conn.execute('DELETE FROM entries WHERE expires <= ?',
+                    (datetime.date.today().toordinal(),))
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT 1 FROM entries LIMIT 1').fetchone() is None
+
+    def compact(self, ttl_for, key_function=None, batch_size=1000):
+        """
+        Prunes expired entries, merges the entries whose keys are
+        equivalent under key_function (keeping the most recent one)
+        and rewrites the database file. Keys are streamed through a
+        temporary table, so the entries are never all in memory.
+        """
+        self.prune(ttl_for)
+        if key_function:
+            with self.lock:
+                self.conn.execute('PRAGMA temp_store=FILE')
+                self.conn.execute('CREATE TEMP TABLE canonical ('
+                        'key TEXT PRIMARY KEY, canonical TEXT, day INTEGER)')
+                try:
+                    self.merge_equivalent_keys(key_function, batch_size)
+                finally:
+                    self.conn.execute('DROP TABLE temp.canonical')
+        with self.lock:
+            self.conn.execute('VACUUM')
+
+    def merge_equivalent_keys(self, key_function, batch_size):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            batch = []
+            for key, day in conn.execute('SELECT key, day FROM entries'):
+                batch.append((key, key_function(key), day))
+                if len(batch) >= batch_size:
+                    self.conn.executemany(
+                        'INSERT INTO temp.canonical VALUES (?, ?, ?)', batch)
+                    batch = []
+            self.conn.executemany(
+                'INSERT INTO temp.canonical VALUES (?, ?, ?)', batch)
+        finally:
+            conn.close()
+        self.conn.execute('CREATE INDEX temp.canonical_idx '
+                'ON canonical (canonical, day)')
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # keep the most recent entry of each group
+            self.conn.execute('DELETE FROM entries WHERE key IN ('
+                'SELECT c.key FROM temp.canonical c '
+                'WHERE EXISTS (SELECT 1 FROM temp.canonical d '
+                'WHERE d.canonical = c.canonical AND '
+                '(d.day > c.day OR (d.day = c.day AND d.key < c.key))))')
+            # and store it under the canonical key
+            self.conn.execute('UPDATE OR REPLACE entries SET key = ('
+                'SELECT canonical FROM temp.canonical c WHERE c.key = entries.key) '
+                'WHERE key IN (SELECT key FROM temp.canonical '
+                'WHERE key != canonical)')
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+def open_backend(path):
+    """
+    Picks the storage backend from the extension of the cache file
+    """
+    if path.endswith('.sqlite') or path.endswith('.db'):
+        return SqliteBackend(path)
+    return PickleBackend(path)
+
+class OnDiskCache(object):
+    def __init__(self, path, ttl=datetime.timedelta(days=365), ttl_policy=None,
+                    backend=None, migrate_from=None, capacity=None,
+                    snapshot=None, key_function=None):
+        """
+        :param path: the file where the cache is stored ('.sqlite' and
+            '.db' files use the SQLite backend, other files are pickled)
+        :param ttl: how long entries are kept
+        :param ttl_policy: optionally, a function returning the TTL
+            of an entry given its value (overrides ttl)
+        :param backend: a storage backend to use instead of the one
+            picked from the path
+        :param migrate_from: a pickled cache whose entries are imported
+            when the cache is empty
+        :param capacity: the maximum number of entries kept in memory
+            (None for no limit). Other entries are read from the backend
+            when needed, which only saves memory with the SQLite backend:
+            the pickle backend always holds the whole cache.
+        :param snapshot: the path of a snapshot of the cache, published
+            with publish_snapshot, which is looked up before the backend.
+            The snapshot is shared by all processes through mmap, so the
+            backend is only read for entries which are not in it.
+        :param key_function: used by `cached` to compute the key
+            under which the result for an argument is stored
+        """
+        self.path = path
+        self.store = LRUStore(capacity)
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.flush_event = None
+        self.flush_batch_size = None
+        self.ttl = ttl
+        self.ttl_policy = ttl_policy
+        self.key_function = key_function
+        self.backend = backend
+        if path and backend is None:
+            self.backend = open_backend(path)
+        if migrate_from:
+            self.migrate(migrate_from)
+        self.snapshot_path = snapshot
+        self.snapshot = None
+        if snapshot and isfile(snapshot):
+            self.snapshot = CacheSnapshot(snapshot)
+
+    def load(self):
+        if self.backend:
+            self.backend.load()
+
+    def migrate(self, pickle_path):
+        """
+        Imports the entries of a pickled cache, if this
+        cache is still empty (with the SQLite backend)
+        """
+        if not isfile(pickle_path) or not isinstance(self.backend, SqliteBackend):
+            return
+        if not self.backend.is_empty():
+            return
+        entries = PickleBackend(pickle_path).load()
+        # other processes may be migrating at the same time:
+        # do not overwrite what they have written
+        self.backend.write(entries, self.ttl_for, replace=False)
+        self.backend.prune(self.ttl_for)
+
+    def ttl_for(self, val):
+        if self.ttl_policy:
+            return self.ttl_policy(val)
+        return self.ttl
+
+    def fresh(self, date, val=None):
+        return date+self.ttl_for(val) > datetime.date.today()
 
     def prune(self):
-        for k in list(self.store.keys()):
-            d, v = self.store[k]
-            if not self.fresh(d):
-                del self.store[k]
-
-    def save(self, reload_before=True):
-        if reload_before:
-            new_store = {}
-            with open(self.path, 'rb') as f:
-                new_store = cPickle.load(f)
-            self.store.update(new_store)
-        
-        self.prune()
+        for k in self.store.keys():
+            entry = self.store.get(k)
+            if entry is not None and not self.fresh(*entry):
+                self.store.pop(k)
+        if self.backend:
+            self.backend.prune(self.ttl_for)
 
-        with open(self.path, 'wb') as f:
-            cPickle.dump(self.store, f)
+    def save(self):
+        """
+        Writes the entries set since the last save to the disk
+        """
+        if not self.backend:
+            return
+        with self.save_lock:
+            with self.lock:
+                dirty, self.dirty = self.dirty, {}
+            if not dirty:
+                return
+            try:
+                self.backend.write(dirty, self.ttl_for)
+            except:
+                with self.lock:
+                    for k, entry in dirty.iteritems():
+                        self.dirty.setdefault(k, entry)
+                raise
+
+    def start_flushing(self, interval=60, batch_size=500):
+        """
+        Saves new entries in a background thread: every `interval`
+        seconds, as soon as `batch_size` entries are waiting to be
+        written, and when the interpreter exits.
+        """
+        if self.flush_event:
+            return
+        self.flush_batch_size = batch_size
+        self.flush_event = threading.Event()
+        thread = threading.Thread(target=self.flush_loop, args=(interval,))
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.save)
+
+    def flush_loop(self, interval):
+        while True:
+            self.flush_event.wait(interval)
+            self.flush_event.clear()
+            try:
+                self.save()
+            except Exception as e:
+                print('Could not save cache %s: %s' % (self.path, e))
+            self.refresh_snapshot()
+
+    def refresh_snapshot(self):
+        """
+        Picks up a snapshot published since the cache was opened
+        """
+        if self.snapshot:
+            self.snapshot.refresh()
+        elif self.snapshot_path and isfile(self.snapshot_path):
+            self.snapshot = CacheSnapshot(self.snapshot_path)
+
+    def publish_snapshot(self, path=None):
+        """
+        Writes a snapshot of all the fresh entries of the cache,
+        which processes opening the cache with this snapshot path
+        will share.
+        """
+        path = path or self.snapshot_path
+        self.save()
+        write_snapshot(path, ((k, entry) for k, entry in self.iteritems()
+                                if self.fresh(*entry)))
+        self.refresh_snapshot()
+
+    def lookup(self, key):
+        """
+        Returns the (date, value) pair stored for a key, or None
+        """
+        entry = self.store.get(key) or self.dirty.get(key)
+        if entry is None and self.snapshot:
+            entry = self.snapshot.get(key)
+            if entry is not None and self.fresh(*entry):
+                # served from the shared mapping: not copied
+                # in the memory of this process
+                return entry
+            # the backend may hold a more recent entry
+            entry = None
+        if entry is None and self.backend:
+            entry = self.backend.get(key)
+            if entry is not None:
+                self.store[key] = entry
+        return entry
 
     def __contains__(self, url):
-        return url in self.store and self.fresh(self.store[url][0])
-    
+        entry = self.lookup(url)
+        return entry is not None and self.fresh(*entry)
+
+    def peek(self, url):
+        """
+        Same as get, without counting the lookup in the statistics
+        """
+        entry = self.lookup(url)
+        if entry is not None and self.fresh(*entry):
+            return entry[1]
+
     def get(self, url):
-        if url in self:
-            return self.store[url][1]
-        
+        return self.count_lookup(self.peek(url))
+
+    def count_lookup(self, val):
+        if val is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return val
+
     def set(self, url, val):
-        self.store[url] = (datetime.date.today(), val)
+        entry = (datetime.date.today(), val)
+        with self.lock:
+            self.store[url] = entry
+            self.dirty[url] = entry
+            nb_dirty = len(self.dirty)
+        if self.flush_event and nb_dirty >= self.flush_batch_size:
+            self.flush_event.set()
+
+    def iteritems(self):
+        """
+        Iterates over all the (key, (date, value)) pairs,
+        including the ones which have not been saved yet
+        """
+        dirty = dict(self.dirty)
+        if self.backend:
+            for k, entry in self.backend.iteritems():
+                if k not in dirty:
+                    yield k, entry
+        for k, entry in dirty.iteritems():
+            yield k, entry
+
+    def outcome(self, val):
+        if val is TRANSIENT_FAILURE:
+            return 'transient'
+        return 'positive' if val else 'negative'
+
+    def stats(self, nb_domains=10):
+        """
+        Statistics about the contents of the cache: number of entries
+        by outcome and by age, largest domains (for URL keys), and
+        the hit ratio of the lookups made since the cache was opened.
+        The entries are streamed from the backend.
+        """
+        today = datetime.date.today()
+        age_buckets = [(1, '< 1 day'), (7, '< 1 week'), (30, '< 1 month'),
+                    (365, '< 1 year')]
+        by_outcome = Counter()
+        by_age = Counter()
+        domains = Counter()
+        total = 0
+        expired = 0
+        for k, (d, v) in self.iteritems():
+            total += 1
+            if not self.fresh(d, v):
+                expired += 1
+            by_outcome[self.outcome(v)] += 1
+            age = (today - d).days
+            for limit, label in age_buckets:
+                if age < limit:
+                    by_age[label] += 1
+                    break
+            else:
+                by_age['older'] += 1
+            domain = extract_domain(k) if isinstance(k, basestring) else None
+            if domain:
+                domains[domain] += 1
+        stats = {
+            'entries': total,
+            'expired': expired,
+            'by_outcome': dict(by_outcome),
+            'by_age': dict(by_age),
+            'top_domains': domains.most_common(nb_domains),
+        }
+        stats.update(self.lookup_stats())
+        return stats
+
+    def lookup_stats(self):
+        """
+        Hit ratio of the lookups made by this process since the cache
+        was opened, and size of its in-memory part (cheap to compute:
+        this is what the web app exposes)
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else None,
+            'in_memory': len(self.store),
+            'evictions': self.store.evictions,
+        }
+
+    def compact(self):
+        """
+        Saves pending entries, then prunes expired entries, merges
+        the entries whose keys are equivalent under the key function
+        and rewrites the storage.
+        """
+        self.save()
+        if self.backend:
+            self.backend.compact(self.ttl_for, self.key_function)
+        self.prune()
 
     def print_contents(self):
-        for k in self.store:
-            print '\t'.join([unicode(self.store[k][1]), k])
+        for k, (d, v) in self.iteritems():
+            print '\t'.join([unicode(v), k])
 
     def cached(self, fun):
         def new_fun(arg):
-            cur_val = self.get(arg)
+            key = self.key_function(arg) if self.key_function else arg
+            cur_val = self.peek(key)
+            if cur_val is None and key != arg:
+                # entries stored before the key function was introduced
+                cur_val = self.peek(arg)
+            self.count_lookup(cur_val)
             if cur_val is not None:
                 return cur_val
             new_val = fun(arg)
-            self.set(arg, new_val)
+            self.set(key, new_val)
             return new_val
         return new_fun
- 
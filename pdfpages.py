@@ -0,0 +1,125 @@
+# -*- encoding: utf-8 -*-
+"""
+Lightweight page counting for PDF files.
+
+Instead of parsing the whole document, we look for the few objects
+which give the number of pages: the linearization dictionary at the
+start of linearized files, or the /Count of the page tree root
+(found from the /Root of the trailer or cross-reference stream,
+including in compressed object streams). When these cannot be
+found, the caller should fall back on a full parser.
+"""
+from __future__ import unicode_literals
+import re
+import zlib
+
+linearized_re = re.compile(br'/Linearized\b[^>]*?/N\s+(\d+)')
+root_re = re.compile(br'/Root\s+(\d+)\s+\d+\s+R')
+pages_re = re.compile(br'/Pages\s+(\d+)\s+\d+\s+R')
+count_re = re.compile(br'/Count\s+(\d+)')
+page_re = re.compile(br'/Type\s*/Page(?![A-Za-z])')
+objstm_re = re.compile(br'/Type\s*/ObjStm')
+length_re = re.compile(br'/Length\s+(\d+)(?!\s+\d+\s+R)')
+first_re = re.compile(br'/First\s+(\d+)')
+nb_objects_re = re.compile(br'/N\s+(\d+)')
+
+def linearized_page_count(data):
+    """
+    Number of pages announced by the linearization dictionary,
+    which comes first in linearized files (None if not linearized)
+    """
+    match = linearized_re.search(data[:4096])
+    if match:
+        return int(match.group(1))
+
+def find_object(data, number):
+    """
+    Returns the body of the last definition of an object
+    (the latest incremental update), or None
+    """
+    body = None
+    for match in re.finditer(br'(?<!\d)%d\s+\d+\s+obj\b(.*?)endobj' % number,
+                data, re.DOTALL):
+        body = match.group(1)
+    if body is None:
+        body = find_compressed_object(data, number)
+    return body
+
+def find_compressed_object(data, number):
+    """
+    Looks for an object in the compressed object streams
+    """
+    for match in objstm_re.finditer(data):
+        start = data.rfind(b'obj', 0, match.start())
+        stream_start = data.find(b'stream', match.end())
+        if start == -1 or stream_start == -1:
+            continue
+        dct = data[start:stream_start]
+        if b'/FlateDecode' not in dct or b'/DecodeParms' in dct:
+            continue
+        first = first_re.search(dct)
+        nb_objects = nb_objects_re.search(dct)
+        if not first or not nb_objects:
+            continue
+
+        stream_start += len(b'stream')
+        if data[stream_start:stream_start+2] == b'\r\n':
+            stream_start += 2
+        elif data[stream_start:stream_start+1] in (b'\r', b'\n'):
+            stream_start += 1
+        length = length_re.search(dct)
+        if length:
+            raw = data[stream_start:stream_start+int(length.group(1))]
+        else:
+            raw = data[stream_start:]
+        try:
+            stream = zlib.decompressobj().decompress(raw)
+        except zlib.error:
+            continue
+        first = int(first.group(1))
+        header = stream[:first].split()
+        pairs = [(int(header[i]), int(header[i+1]))
+                    for i in range(0, min(len(header)-1, 2*int(nb_objects.group(1))), 2)]
+        for idx, (num, offset) in enumerate(pairs):
+            if num == number:
+                end = pairs[idx+1][1] if idx+1 < len(pairs) else len(stream)-first
+                return stream[first+offset:first+end]
+
+def count_pages(data):
+    """
+    Returns the number of pages of a PDF file, or None
+    if it could not be found cheaply
+    """
+    nb = linearized_page_count(data)
+    if nb is not None:
+        return nb
+
+    roots = root_re.findall(data)
+    if not roots:
+        return None
+    root = find_object(data, int(roots[-1]))
+    if root is None:
+        return None
+    pages_ref = pages_re.search(root)
+    if not pages_ref:
+        return None
+    pages = find_object(data, int(pages_ref.group(1)))
+    if pages is None:
+        return None
+    count = count_re.search(pages)
+    if count:
+        return int(count.group(1))
+
+def more_pages_than(data, n):
+    """
+    Does this PDF have more than n pages? Returns True or False,
+    or None if this cannot be decided cheaply. This also works
+    on the beginning of a file: if more than n page objects are
+    found there, the answer is True.
+    """
+    nb = count_pages(data)
+    if nb is not None:
+        return nb > n
+    if len(page_re.findall(data)) > n:
+        return True
+    return None
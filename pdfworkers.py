@@ -0,0 +1,170 @@
+# -*- encoding: utf-8 -*-
+"""
+Process pool running the full PDF parser.
+
+PyPDF2 is pure Python: parsing a large or malformed PDF in the
+request thread holds the GIL and can take forever. Here documents
+are parsed in worker processes, each with a memory cap, a per-document
+time limit (enforced in the worker with SIGALRM, and by the parent
+which restarts the pool if a worker does not answer in time) and a
+maximum number of documents after which it is replaced.
+"""
+from __future__ import unicode_literals
+import time
+import signal
+import resource
+import threading
+import multiprocessing
+import PyPDF2
+from PyPDF2.utils import PyPdfError
+from StringIO import StringIO
+from settings import *
+from ondiskcache import TRANSIENT_FAILURE
+
+class AnalysisTimeout(Exception):
+    pass
+
+def on_alarm(signum, frame):
+    raise AnalysisTimeout()
+
+def init_worker(memory_limit):
+    # the parent handles interruptions
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGALRM, on_alarm)
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+def pypdf_page_count(data, timeout=None):
+    """
+    Number of pages of a PDF according to PyPDF2, or None if
+    it could not be parsed within `timeout` seconds
+    """
+    if timeout:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        reader = PyPDF2.PdfFileReader(StringIO(data))
+        return reader.getNumPages()
+    except (PyPdfError, AnalysisTimeout, MemoryError):
+        return None
+    except Exception as e:
+        # PyPDF2 raises all sorts of errors on malformed files
+        print('PyPDF2 failed: %s' % e)
+        return None
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+class Slot(object):
+    """
+    A place taken in the pool by one document, freed once
+    (when the document is parsed or when its caller gives up)
+    """
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        self.lock = threading.Lock()
+        self.held = True
+
+    def release(self, *args):
+        with self.lock:
+            if not self.held:
+                return
+            self.held = False
+        self.semaphore.release()
+
+class PdfAnalysisPool(object):
+    """
+    A pool of worker processes counting the pages of PDF files.
+
+    The pool is shared by all threads: at most one document per worker
+    is handed to it at a time, the others wait for a free slot. This
+    way, a document starts being parsed as soon as it is submitted,
+    and its time limit does not include the time spent waiting
+    behind the documents of other threads.
+    """
+    def __init__(self, processes=OABOT_PDF_WORKERS,
+                    timeout=OABOT_PDF_TIMEOUT,
+                    memory_limit=OABOT_PDF_MEMORY_LIMIT,
+                    tasks_per_worker=OABOT_PDF_TASKS_PER_WORKER):
+        """
+        :param processes: the number of worker processes
+        :param timeout: the time limit for each document, in seconds
+        :param memory_limit: the address space limit of each worker, in bytes
+        :param tasks_per_worker: the number of documents processed by a
+            worker before it is replaced
+        """
+        self.processes = processes
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.tasks_per_worker = tasks_per_worker
+        self.pool = None
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(processes)
+
+    def get_pool(self):
+        # created lazily: processes which never parse PDFs do not fork
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes,
+                        initializer=init_worker,
+                        initargs=(self.memory_limit,),
+                        maxtasksperchild=self.tasks_per_worker)
+            return self.pool
+
+    def restart(self, pool):
+        """
+        Kills the workers of a pool which stopped answering
+        (unless it has already been replaced)
+        """
+        with self.lock:
+            if self.pool is not pool:
+                return
+            self.pool = None
+        pool.terminate()
+
+    def submit(self, data):
+        """
+        Waits for a free worker and hands it a document. Returns the
+        pending result, the time by which it should be ready, the
+        slot taken by the document and the pool.
+        """
+        self.slots.acquire()
+        slot = Slot(self.slots)
+        try:
+            pool = self.get_pool()
+            result = pool.apply_async(pypdf_page_count,
+                        (data, self.timeout), callback=slot.release)
+        except:
+            slot.release()
+            raise
+        # workers interrupt themselves after self.timeout: this is
+        # only exceeded if a worker is stuck (in C code, for instance)
+        return result, time.time() + self.timeout + 5, slot, pool
+
+    def count_pages(self, data):
+        """
+        Number of pages of a PDF, None if it could not be parsed,
+        or TRANSIENT_FAILURE if the pool failed to answer
+        """
+        return self.count_pages_many([data])[0]
+
+    def count_pages_many(self, datas):
+        """
+        Number of pages of several PDFs, parsed in parallel
+        (as returned by count_pages)
+        """
+        pending = [self.submit(data) for data in datas]
+        counts = []
+        for result, deadline, slot, pool in pending:
+            try:
+                counts.append(result.get(max(deadline - time.time(), 0.1)))
+            except multiprocessing.TimeoutError:
+                # a worker is stuck on this document
+                self.restart(pool)
+                counts.append(TRANSIENT_FAILURE)
+            except Exception:
+                counts.append(TRANSIENT_FAILURE)
+            finally:
+                slot.release()
+        return counts
+
+pdf_pool = PdfAnalysisPool()
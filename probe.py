@@ -0,0 +1,100 @@
+# -*- encoding: utf-8 -*-
+"""
+Cheap checks on candidate URLs, done before asking the Zotero
+translation server about them. A HEAD request (confirmed by a
+GET when the server does not answer it with a success) tells us
+where the URL leads to, and whether it is worth translating.
+"""
+from __future__ import unicode_literals
+import threading
+from collections import Counter
+from urlparse import urlparse
+import httpclient
+from settings import *
+
+# outcomes of probe_url
+DEAD = 'dead'                   # 404, 410: nothing to translate
+PAYWALLED = 'paywalled'         # 401, 402: requires a login or payment
+PDF = 'pdf'                     # direct link to a PDF file
+NOT_A_PAGE = 'not_a_page'       # neither HTML nor PDF (images, archives…)
+LANDING_PAGE = 'landing_page'   # anything else: Zotero should look at it
+
+dead_statuses = [404, 410]
+paywalled_statuses = [401, 402]
+pdf_content_types = ['application/pdf', 'application/x-pdf']
+ambiguous_content_types = ['', 'application/octet-stream', 'binary/octet-stream',
+        'application/download', 'application/force-download']
+
+class ProbeResult(object):
+    """
+    What we learnt about an URL: the outcome of the probe
+    and the URL reached after following redirects
+    """
+    def __init__(self, outcome, url, status_code=None, content_type=''):
+        self.outcome = outcome
+        self.url = url
+        self.status_code = status_code
+        self.content_type = content_type
+
+    def __repr__(self):
+        return '<ProbeResult %s %s>' % (self.outcome, self.url)
+
+def classify_response(r, url):
+    """
+    Returns the ProbeResult corresponding to a response
+    """
+    final_url = r.url or url
+    content_type = r.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if r.status_code in dead_statuses:
+        outcome = DEAD
+    elif r.status_code in paywalled_statuses:
+        outcome = PAYWALLED
+    elif r.status_code >= 400:
+        # server errors, bot blocking (403)… let Zotero try
+        outcome = LANDING_PAGE
+    elif content_type in pdf_content_types:
+        outcome = PDF
+    elif (content_type in ambiguous_content_types and
+          urlparse(final_url).path.lower().endswith('.pdf')):
+        outcome = PDF
+    elif content_type.split('/')[0] in ('image', 'audio', 'video') or (
+          content_type in ('application/zip', 'application/gzip')):
+        outcome = NOT_A_PAGE
+    else:
+        outcome = LANDING_PAGE
+    return ProbeResult(outcome, final_url, r.status_code, content_type)
+
+def probe_url(url):
+    """
+    Follows the redirects of an URL and guesses what it leads to.
+    Some servers do not implement HEAD properly, so every answer
+    other than a success is checked again with a GET (only the
+    headers of which are read).
+
+    Raises requests exceptions if the server cannot be reached.
+    """
+    headers = {'User-Agent':OABOT_USER_AGENT}
+    r = httpclient.head(url, headers=headers, allow_redirects=True,
+                    verify=False, timeout=OABOT_PROBE_TIMEOUT)
+    r.close()
+    if r.status_code >= 300:
+        r = httpclient.get(url, headers=headers, allow_redirects=True,
+                    verify=False, stream=True, timeout=OABOT_PROBE_TIMEOUT)
+        r.close()
+    return classify_response(r, url)
+
+class StageCounter(object):
+    """
+    Thread-safe counters of the stages reached when checking URLs
+    """
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, stage):
+        with self.lock:
+            self.counts[stage] += 1
+
+    def as_dict(self):
+        with self.lock:
+            return dict(self.counts)
@@ -0,0 +1,440 @@
+# -*- encoding: utf-8 -*-
+"""
+Storage of the edits proposed for each page, in SQLite.
+
+This replaces the JSON files of the cache/ directory: pages and
+proposed edits are stored in indexed tables, so that finding the
+proposals of a page or drawing a random edit does not require
+listing or parsing the whole cache.
+
+Reviewers are given random edits through short leases: an edit
+shown to a reviewer is reserved for them until they act on it or
+the lease expires, so that concurrent reviewers get different edits.
+Leases are taken with a conditional UPDATE, which is atomic in SQLite
+(including across processes), so no other locking is needed.
+
+The background jobs processing pages (see jobs.py) are also recorded
+here, with the edits they have found so far, so that every process of
+the web app can report their progress.
+"""
+from __future__ import unicode_literals
+import os
+import json
+import math
+import time
+import uuid
+import random
+import sqlite3
+import threading
+from settings import OABOT_EDIT_LEASE, OABOT_EDIT_AGE_WEIGHT_DAYS
+
+def normalize_title(title):
+    """
+    Titles which only differ by spaces and underscores are the same page
+    """
+    return title.replace('_', ' ').strip()
+
+class ProposalStore(object):
+    """
+    Pages processed by the bot (with the revision they were
+    processed at) and the edits proposed for them.
+    Like the SQLite caches, the database is opened in WAL mode.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30,
+                    check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pages ('
+                    'title TEXT PRIMARY KEY, '
+                    'revid INTEGER, '
+                    'timestamp TEXT, '
+                    'utcnow TEXT, '
+                    'nb_incomplete INTEGER NOT NULL DEFAULT 0, '
+                    'unavailable_hosts TEXT NOT NULL DEFAULT \'[]\', '
+                    'pageviews INTEGER NOT NULL DEFAULT 0)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS edits ('
+                    'id INTEGER PRIMARY KEY, '
+                    'page TEXT NOT NULL, '
+                    'orig_hash TEXT NOT NULL, '
+                    'idx INTEGER, '
+                    'classification TEXT, '
+                    'orig_string TEXT NOT NULL, '
+                    'proposed_change TEXT, '
+                    'proposed_link TEXT, '
+                    'conflicting_value TEXT, '
+                    'created REAL NOT NULL, '
+                    'priority REAL NOT NULL DEFAULT 0, '
+                    'leased_by TEXT, '
+                    'lease_expires REAL, '
+                    'UNIQUE (page, orig_hash))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                    'id TEXT PRIMARY KEY, '
+                    'page TEXT NOT NULL, '
+                    'status TEXT NOT NULL, '
+                    'context TEXT, '
+                    'error TEXT, '
+                    'heartbeat REAL NOT NULL, '
+                    'finished REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_page ON jobs (page)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS job_edits ('
+                    'job TEXT NOT NULL, '
+                    'seq INTEGER NOT NULL, '
+                    'edit TEXT NOT NULL, '
+                    'PRIMARY KEY (job, seq))')
+        self.add_missing_columns()
+        for column in ['orig_hash', 'classification', 'created', 'leased_by']:
+            self.conn.execute('CREATE INDEX IF NOT EXISTS edits_%s '
+                    'ON edits (%s)' % (column, column))
+
+    def add_missing_columns(self):
+        """
+        Upgrades databases created before leases were introduced
+        """
+        for table, column, definition in [
+                ('pages', 'pageviews', 'INTEGER NOT NULL DEFAULT 0'),
+                ('edits', 'priority', 'REAL NOT NULL DEFAULT 0'),
+                ('edits', 'leased_by', 'TEXT'),
+                ('edits', 'lease_expires', 'REAL')]:
+            columns = [row[1] for row in
+                    self.conn.execute('PRAGMA table_info(%s)' % table)]
+            if column not in columns:
+                self.conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table, column, definition))
+
+    def execute(self, query, args=()):
+        with self.lock:
+            return self.conn.execute(query, args).fetchall()
+
+    def query(self, query, args=()):
+        """
+        Same as execute, returning the rows as dicts
+        """
+        with self.lock:
+            cursor = self.conn.execute(query, args)
+            columns = [description[0] for description in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def store_page(self, context):
+        """
+        Stores the proposed edits for a page (as returned by
+        get_proposed_edits), replacing the previous ones
+        """
+        title = normalize_title(context['page_name'])
+        now = time.time()
+        pageviews = context.get('pageviews') or 0
+        priority = math.log1p(pageviews)
+        rows = [(title, edit['orig_hash'], edit.get('index'),
+                 edit.get('classification'), edit['orig_string'],
+                 edit.get('proposed_change'), edit.get('proposed_link'),
+                 edit.get('conflicting_value'), now, priority)
+                for edit in context.get('proposed_edits', [])]
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute('INSERT OR REPLACE INTO pages '
+                    '(title, revid, timestamp, utcnow, nb_incomplete, '
+                    'unavailable_hosts, pageviews) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (title, context.get('revid'), context.get('timestamp'),
+                     context.get('utcnow'), context.get('nb_incomplete', 0),
+                     json.dumps(context.get('unavailable_hosts', [])), pageviews))
+                self.conn.execute('DELETE FROM edits WHERE page = ?', (title,))
+                self.conn.executemany('INSERT OR REPLACE INTO edits '
+                    '(page, orig_hash, idx, classification, orig_string, '
+                    'proposed_change, proposed_link, conflicting_value, created, '
+                    'priority) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def update_revision(self, title, revid, timestamp, kept_hashes):
+        """
+        Records that the proposals for a page are still valid at a new
+        revision, except those whose hash is not in kept_hashes (which
+        are removed, as well as the page if none is left)
+        """
+        if not kept_hashes:
+            self.remove_page(title)
+            return
+        title = normalize_title(title)
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute('UPDATE pages SET revid = ?, timestamp = ? '
+                    'WHERE title = ?', (revid, timestamp, title))
+                self.conn.execute('DELETE FROM edits WHERE page = ? AND '
+                    'orig_hash NOT IN (%s)' % ', '.join('?' * len(kept_hashes)),
+                    [title] + list(kept_hashes))
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def remove_page(self, title):
+        title = normalize_title(title)
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute('DELETE FROM edits WHERE page = ?', (title,))
+                self.conn.execute('DELETE FROM pages WHERE title = ?', (title,))
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def has_page(self, title):
+        return bool(self.execute('SELECT 1 FROM pages WHERE title = ?',
+                    (normalize_title(title),)))
+
+    def edit_json(self, row):
+        return {
+            'orig_string': row['orig_string'],
+            'orig_hash': row['orig_hash'],
+            'classification': row['classification'],
+            'conflicting_value': row['conflicting_value'],
+            'proposed_change': row['proposed_change'],
+            'proposed_link': row['proposed_link'],
+            'index': row['idx'],
+        }
+
+    def get_page(self, title):
+        """
+        Returns the proposed edits for a page in the format of
+        get_proposed_edits, or None if the page is not stored
+        """
+        title = normalize_title(title)
+        pages = self.query('SELECT * FROM pages WHERE title = ?', (title,))
+        if not pages:
+            return None
+        page = pages[0]
+        edits = self.query('SELECT * FROM edits WHERE page = ? ORDER BY idx',
+                    (title,))
+        return {
+            'proposed_edits': [self.edit_json(row) for row in edits],
+            'page_name': page['title'],
+            'revid': page['revid'],
+            'timestamp': page['timestamp'],
+            'utcnow': page['utcnow'],
+            'nb_incomplete': page['nb_incomplete'],
+            'unavailable_hosts': json.loads(page['unavailable_hosts']),
+            'pageviews': page['pageviews'],
+        }
+
+    def get_edit(self, title, orig_hash):
+        rows = self.query('SELECT * FROM edits WHERE page = ? AND orig_hash = ?',
+                    (normalize_title(title), orig_hash))
+        if rows:
+            return self.edit_json(rows[0])
+
+    def random_edit(self):
+        """
+        Returns a random proposed edit, as a (page title, edit) pair
+        (or None if there is none). We pick a random id and take the
+        first edit from there: this only reads a few index entries.
+        """
+        low, high = self.execute('SELECT MIN(id), MAX(id) FROM edits')[0]
+        if low is None:
+            return None
+        pivot = random.randint(low, high)
+        rows = self.query('SELECT * FROM edits WHERE id >= ? ORDER BY id LIMIT 1',
+                    (pivot,))
+        if not rows:
+            # the last edits were removed meanwhile
+            return None
+        return rows[0]['page'], self.edit_json(rows[0])
+
+    def lease_edit(self, user, duration=OABOT_EDIT_LEASE, nb_candidates=5, attempts=5):
+        """
+        Returns a random edit (as random_edit does), reserved for
+        `user` for `duration` seconds. The leases previously held
+        by the user are released: the edit they skipped is not
+        proposed to them again until someone else has reviewed it.
+
+        `nb_candidates` edits which are not reserved are drawn as
+        in random_edit, and one of them is chosen according to
+        their priority and age. If another reviewer reserved it
+        meanwhile, we try again (up to `attempts` times).
+        """
+        self.release_leases(user)
+        for attempt in range(attempts):
+            now = time.time()
+            low, high = self.execute('SELECT MIN(id), MAX(id) FROM edits')[0]
+            if low is None:
+                return None
+            candidates = {}
+            for i in range(nb_candidates):
+                for start in (random.randint(low, high), low):
+                    rows = self.query('SELECT id, priority, created FROM edits '
+                        'WHERE id >= ? AND (lease_expires IS NULL OR lease_expires < ?) '
+                        'AND (leased_by IS NULL OR leased_by != ?) '
+                        'ORDER BY id LIMIT 1', (start, now, user))
+                    if rows:
+                        candidates[rows[0]['id']] = rows[0]
+                        break
+            if not candidates:
+                return None
+
+            chosen = self.weighted_choice(list(candidates.values()), now)
+            with self.lock:
+                claimed = self.conn.execute('UPDATE edits SET leased_by = ?, '
+                    'lease_expires = ? WHERE id = ? AND '
+                    '(lease_expires IS NULL OR lease_expires < ?)',
+                    (user, now + duration, chosen['id'], now)).rowcount
+            if claimed:
+                rows = self.query('SELECT * FROM edits WHERE id = ?', (chosen['id'],))
+                if rows:
+                    return rows[0]['page'], self.edit_json(rows[0])
+        return None
+
+    def weighted_choice(self, candidates, now):
+        """
+        Picks one of the candidates (with their priority and creation
+        time) with a probability proportional to their weight
+        """
+        weights = [(1 + c['priority']) *
+                   (1 + (now - c['created']) / (86400. * OABOT_EDIT_AGE_WEIGHT_DAYS))
+                   for c in candidates]
+        threshold = random.uniform(0, sum(weights))
+        for candidate, weight in zip(candidates, weights):
+            threshold -= weight
+            if threshold <= 0:
+                return candidate
+        return candidates[-1]
+
+    def release_leases(self, user):
+        """
+        Makes the edits reserved for a user available to others
+        """
+        if user:
+            with self.lock:
+                self.conn.execute('UPDATE edits SET lease_expires = NULL '
+                    'WHERE leased_by = ? AND lease_expires IS NOT NULL', (user,))
+
+    def page_titles(self):
+        """
+        The titles of all the stored pages
+        """
+        return [row[0] for row in self.execute('SELECT title FROM pages')]
+
+    def start_job(self, title, stale_before):
+        """
+        Records a new job for a page, unless one is already running
+        (and has shown signs of life since `stale_before`). Returns
+        the id of the job and whether it is a new one, which the
+        caller must run.
+        """
+        title = normalize_title(title)
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.conn.execute('SELECT id FROM jobs WHERE page = ? '
+                    'AND finished IS NULL AND heartbeat >= ?',
+                    (title, stale_before)).fetchall()
+                if rows:
+                    job_id, created = rows[0][0], False
+                else:
+                    job_id, created = uuid.uuid4().hex, True
+                    self.conn.execute('INSERT INTO jobs (id, page, status, heartbeat) '
+                        'VALUES (?, ?, ?, ?)', (job_id, title, 'pending', now))
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+        return job_id, created
+
+    def update_job(self, job_id, status, context=None, error=None):
+        """
+        Changes the status of a job ('running', 'done' or 'failed',
+        the last two with the final context or the error)
+        """
+        now = time.time()
+        finished = now if status in ('done', 'failed') else None
+        self.execute('UPDATE jobs SET status = ?, context = ?, error = ?, '
+            'heartbeat = ?, finished = ? WHERE id = ?',
+            (status, json.dumps(context) if context is not None else None,
+             error, now, finished, job_id))
+
+    def touch_jobs(self, job_ids):
+        """
+        Records that the process running these jobs is still alive
+        """
+        if job_ids:
+            self.execute('UPDATE jobs SET heartbeat = ? WHERE id IN (%s)' %
+                ', '.join('?' * len(job_ids)), [time.time()] + list(job_ids))
+
+    def add_job_edit(self, job_id, edit):
+        """
+        Appends an edit found by a job
+        """
+        self.execute('INSERT INTO job_edits (job, seq, edit) '
+            'SELECT ?, COUNT(*), ? FROM job_edits WHERE job = ?',
+            (job_id, json.dumps(edit), job_id))
+
+    def job_progress(self, job_id, since, stale_before):
+        """
+        The state of a job and the edits it found after the first
+        `since` (None if the job is unknown). Jobs which have not shown
+        signs of life since `stale_before` are reported as failed.
+        """
+        jobs = self.query('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        if not jobs:
+            return None
+        job = jobs[0]
+        edits = [json.loads(row[0]) for row in self.execute('SELECT edit '
+            'FROM job_edits WHERE job = ? AND seq >= ? ORDER BY seq',
+            (job_id, since))]
+        status, error = job['status'], job['error']
+        if job['finished'] is None and job['heartbeat'] < stale_before:
+            status, error = 'failed', 'the processing of the page was interrupted'
+        return {
+            'id': job_id,
+            'status': status,
+            'edits': edits,
+            'next': since + len(edits),
+            'context': json.loads(job['context']) if job['context'] else None,
+            'error': error,
+        }
+
+    def forget_jobs(self, before):
+        """
+        Removes the jobs which finished (or were last seen) before `before`
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute('DELETE FROM job_edits WHERE job IN '
+                    '(SELECT id FROM jobs WHERE COALESCE(finished, heartbeat) < ?)',
+                    (before,))
+                self.conn.execute('DELETE FROM jobs WHERE '
+                    'COALESCE(finished, heartbeat) < ?', (before,))
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def import_directory(self, directory):
+        """
+        Imports the JSON files of the former cache directory.
+        Returns the number of pages imported.
+
+        The file names are the titles of the pages encoded in UTF-8:
+        they are listed as bytes, and only decoded to get the titles.
+        """
+        if not isinstance(directory, bytes):
+            directory = directory.encode('utf-8')
+        nb_pages = 0
+        for fname in sorted(os.listdir(directory)):
+            if not fname.endswith(b'.json'):
+                continue
+            with open(os.path.join(directory, fname), 'r') as f:
+                context = json.load(f)
+            if not context.get('page_name'):
+                name = fname[:-5].decode('utf-8')
+                context['page_name'] = name.replace('#', '/')
+            self.store_page(context)
+            nb_pages += 1
+        return nb_pages
@@ -2,6 +2,8 @@
 
 from __future__ import unicode_literals
 import re
+import threading
+from urlnorm import canonical_url
 
 
 # This section defines a priority order on the links retrieved from APIs
@@ -21,9 +23,138 @@ def extract_domain(url):
     if match:
 	return match.group(2)
 
-def link_rank(url):
-    return (- domain_priority.get(extract_domain(url), 0))
+def stats_domain(url):
+    """
+    Domain under which the checks of an URL are counted: the one of its
+    canonical form, as in the keys of the URLs cache (so that www.example.org
+    and example.org share their statistics)
+    """
+    domain = extract_domain(canonical_url(url) or '')
+    if domain:
+        return domain.lower()
 
-def sort_links(urls):
-    return sorted(urls, key=link_rank)
+def priority_of(domain):
+    """
+    Priority of a domain: the one of the longest suffix of
+    the domain listed in domain_priority (so that
+    www.ncbi.nlm.nih.gov gets the priority of ncbi.nlm.nih.gov)
+    """
+    if not domain:
+        return 0
+    parts = domain.lower().split('.')
+    for i in range(len(parts)):
+        priority = domain_priority.get('.'.join(parts[i:]))
+        if priority is not None:
+            return priority
+    return 0
+
+# Within a priority level, links are ordered by what we learnt from the
+# previous checks of their domain: the expected number of free links
+# found per second spent checking them. Domains without history get
+# the prior hit rate and latency below, weighted as PRIOR_WEIGHT checks.
+PRIOR_HIT_RATE = 0.3
+PRIOR_LATENCY = 5.
+PRIOR_WEIGHT = 5
+# counts are halved beyond this number of checks, so that recent
+# checks weigh more than old ones
+MAX_CHECKS = 1000
+
+class MemoryStore(dict):
+    def set(self, key, val):
+        self[key] = val
+
+class DomainStats(object):
+    """
+    Per-domain statistics of the free-to-read checks: number of
+    checks with a conclusive outcome, number of free links found,
+    number of timed checks and their total duration.
+
+    The statistics are stored in `store`, a cache-like object
+    (with get and set methods, in memory by default) mapping
+    domains (as returned by stats_domain) to tuples.
+
+    Each process updates its own copy of the statistics: when several
+    processes share an OnDiskCache store, the last one to save a domain
+    overwrites the counts of the others. The statistics only guide the
+    order in which links are checked, so this loss is tolerated (and
+    `cachetool.py ranking --rebuild` recomputes the hit rates from
+    the URLs cache, which is shared).
+    """
+    def __init__(self, store=None):
+        self.store = store if store is not None else MemoryStore()
+        self.lock = threading.Lock()
+
+    def get(self, domain):
+        return self.store.get(domain) or (0, 0, 0, 0.)
+
+    def record(self, url, is_free, latency=None):
+        """
+        Records the outcome of a check (None if it was not conclusive)
+        and how long it took in seconds (None if it was not timed)
+        """
+        domain = stats_domain(url)
+        if not domain:
+            return
+        with self.lock:
+            checks, free, timed, duration = self.get(domain)
+            if is_free is not None:
+                checks += 1
+                free += 1 if is_free else 0
+            if latency is not None:
+                timed += 1
+                duration += latency
+            if checks > MAX_CHECKS or timed > MAX_CHECKS:
+                checks, free = checks // 2, free // 2
+                timed, duration = timed // 2, duration / 2
+            self.store.set(domain, (checks, free, timed, duration))
+
+    def rebuild(self, outcomes):
+        """
+        Recomputes the hit rates from (url, is_free) pairs, such
+        as the contents of the URLs cache (latencies are kept)
+        """
+        counts = {}
+        for url, is_free in outcomes:
+            domain = stats_domain(url)
+            if domain and is_free is not None:
+                checks, free = counts.get(domain, (0, 0))
+                counts[domain] = (checks + 1, free + (1 if is_free else 0))
+        with self.lock:
+            for domain, (checks, free) in counts.items():
+                while checks > MAX_CHECKS:
+                    checks, free = checks // 2, free // 2
+                _, _, timed, duration = self.get(domain)
+                self.store.set(domain, (checks, free, timed, duration))
+        return len(counts)
+
+    def hit_rate(self, domain):
+        checks, free, timed, duration = self.get(domain)
+        return (free + PRIOR_HIT_RATE*PRIOR_WEIGHT) / (checks + PRIOR_WEIGHT)
+
+    def latency(self, domain):
+        checks, free, timed, duration = self.get(domain)
+        return (duration + PRIOR_LATENCY*PRIOR_WEIGHT) / (timed + PRIOR_WEIGHT)
+
+    def score(self, domain):
+        """
+        Expected number of free links found per second of checks
+        """
+        if not domain:
+            return PRIOR_HIT_RATE / PRIOR_LATENCY
+        domain = domain.lower()
+        return self.hit_rate(domain) / self.latency(domain)
+
+def link_rank(url, stats=None):
+    domain = stats_domain(url)
+    rank = - priority_of(domain)
+    if stats is None:
+        return rank
+    return (rank, - stats.score(domain))
+
+def sort_links(urls, stats=None):
+    """
+    Sorts links by priority, then (if per-domain statistics
+    are given) by the expected yield of their domain
+    """
+    return sorted(urls, key=lambda url: link_rank(url, stats))
 
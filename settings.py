@@ -37,3 +37,150 @@ FILTER_JAR_PATH = 'resources/classifier.jar'
 FILTER_ACL_PATH = 'resources/acl'
 FILTER_TRAIN_DATA_PATH = 'resources/train_str_f43_paper.arff'
 
+
+# Number of citation templates resolved in parallel for each page.
+# Set this to 1 to resolve them sequentially.
+OABOT_RESOLUTION_WORKERS = 8
+
+# Number of candidate URLs of a citation checked at the same time
+# (the first free one in rank order is still the one returned).
+# Set this to 1 to check them one after another.
+OABOT_SPECULATIVE_PROBES = 3
+
+# Maximum number of simultaneous requests sent to the same host.
+# Individual hosts can be given a different limit in OABOT_HOST_CONCURRENCY.
+OABOT_MAX_REQUESTS_PER_HOST = 4
+OABOT_HOST_CONCURRENCY = {
+    'doi-cache.dissem.in': 4,
+    'dissem.in': 4,
+    'api.oadoi.org': 4,
+}
+
+# Upstream APIs are protected by a circuit breaker and a rate limiter.
+# After OABOT_BREAKER_FAILURES consecutive failures (connection errors,
+# timeouts or 5xx responses) a host is considered unavailable, and requests
+# to it fail immediately for OABOT_BREAKER_RESET seconds. Each host gets
+# a token bucket: (requests per second, burst size).
+OABOT_BREAKER_FAILURES = 5
+OABOT_BREAKER_RESET = 30
+OABOT_HOST_RATE_LIMITS = {
+    'dissem.in': (10, 20),
+    'api.oadoi.org': (10, 20),
+    'doi-cache.dissem.in': (10, 20),
+    'en.wikipedia.org': (20, 40),
+}
+
+# The web app processes uncached pages in OABOT_JOB_WORKERS background
+# threads, and keeps the results of finished jobs for OABOT_JOB_RETENTION
+# seconds so that browsers can fetch them. Running jobs are marked alive
+# every OABOT_JOB_HEARTBEAT seconds: jobs not marked for three times
+# as long are considered interrupted.
+OABOT_JOB_WORKERS = 4
+OABOT_JOB_RETENTION = 600
+OABOT_JOB_HEARTBEAT = 10
+
+# Database of the edits proposed for each page
+OABOT_PROPOSALS_DB = 'proposals.sqlite'
+
+# Random edits are reserved for the reviewer they are shown to during
+# OABOT_EDIT_LEASE seconds. They are drawn with a probability which
+# grows with the page views of their page and with their age (an edit
+# proposed OABOT_EDIT_AGE_WEIGHT_DAYS days ago weighs twice as much as
+# a new one on a page with as many views).
+OABOT_EDIT_LEASE = 600
+OABOT_EDIT_AGE_WEIGHT_DAYS = 30
+
+# Number of recently fetched pages whose wikicode is kept in memory
+# (for OABOT_WIKITEXT_CACHE_TTL seconds, as long as they do not change)
+OABOT_WIKITEXT_CACHE_SIZE = 200
+OABOT_WIKITEXT_CACHE_TTL = 3600
+
+# Number of pages fetched in each query to the Wikipedia API
+# (MediaWiki accepts up to 50 titles per query)
+OABOT_WIKI_API_BATCH = 50
+
+# Citation templates are rendered to HTML by batches of OABOT_RENDER_BATCH
+# per parse request, and the rendered fragments are kept for
+# OABOT_RENDER_CACHE_TTL days.
+OABOT_RENDER_BATCH = 50
+OABOT_RENDER_CACHE_TTL = 30
+
+# Total time (in seconds) spent resolving the citations of a page. It is
+# split across the citations as they are resolved, each of them getting
+# at least OABOT_CITATION_MIN_BUDGET seconds while the page budget lasts.
+OABOT_PAGE_BUDGET = 120
+OABOT_CITATION_MIN_BUDGET = 10
+
+# Outbound HTTP client: connection pools are kept alive per host.
+# OABOT_HTTP_POOL_CONNECTIONS is the number of hosts whose pools are kept,
+# OABOT_HTTP_POOL_MAXSIZE the number of connections kept open per host.
+OABOT_HTTP_POOL_CONNECTIONS = 20
+OABOT_HTTP_POOL_MAXSIZE = 10
+# Idempotent requests failing with a connection error or a 502/503/504
+# are retried, waiting OABOT_HTTP_BACKOFF * 2^n seconds between attempts.
+OABOT_HTTP_RETRIES = 2
+OABOT_HTTP_BACKOFF = 0.5
+# Default (connect, read) timeout in seconds, when the caller sets none.
+OABOT_HTTP_TIMEOUT = (10, 30)
+
+# Number of days for which the link found (or not found) for a given
+# DOI or title by get_oa_link is kept in the resolution cache.
+OABOT_RESOLUTION_CACHE_TTL = 30
+
+# Number of days for which the result of a free-to-read check is kept,
+# depending on its outcome. Checks which failed because of a timeout or
+# a connection error are retried sooner.
+OABOT_CACHE_TTL_FREE = 365
+OABOT_CACHE_TTL_NOT_FREE = 60
+OABOT_CACHE_TTL_TRANSIENT = 1
+
+# New cache entries are written to disk in the background every
+# OABOT_CACHE_FLUSH_INTERVAL seconds, or as soon as
+# OABOT_CACHE_FLUSH_BATCH of them are waiting.
+OABOT_CACHE_FLUSH_INTERVAL = 60
+OABOT_CACHE_FLUSH_BATCH = 500
+
+# Maximum number of cache entries kept in the memory of each process.
+# Less recently used entries are read back from disk when needed.
+OABOT_CACHE_CAPACITY = 100000
+
+# PDF downloads: number of bytes first requested to look for the page
+# count of linearized PDFs, maximum number of bytes read from a PDF and
+# maximum number of seconds spent reading it.
+OABOT_PDF_PROBE_BYTES = 4096
+OABOT_PDF_MAX_BYTES = 20*1024*1024
+OABOT_PDF_READ_DEADLINE = 30
+
+# Number of days for which PDF classifications are kept (by digest of
+# the file), and for which the ETag/Last-Modified headers seen for each
+# PDF URL are kept to make conditional requests.
+OABOT_PDF_DIGESTS_TTL = 365
+OABOT_PDF_VALIDATORS_TTL = 90
+
+# PDFs which need a full parse are parsed by OABOT_PDF_WORKERS worker
+# processes, each limited to OABOT_PDF_MEMORY_LIMIT bytes of memory and
+# OABOT_PDF_TIMEOUT seconds per document, and replaced after
+# OABOT_PDF_TASKS_PER_WORKER documents.
+OABOT_PDF_WORKERS = 2
+OABOT_PDF_TIMEOUT = 20
+OABOT_PDF_MEMORY_LIMIT = 1024*1024*1024
+OABOT_PDF_TASKS_PER_WORKER = 50
+
+# Full-text checks: when OABOT_CHECK_FULL_TEXT is set, PDFs with enough
+# pages are also run through PDFBox and the CiteSeerX filter, in
+# OABOT_JVM_WORKERS long-lived JVMs (with OABOT_JVM_HEAP_MB megabytes of
+# heap each) which are given OABOT_JVM_TIMEOUT seconds per document and
+# restarted after OABOT_JVM_DOCUMENTS_PER_WORKER documents.
+OABOT_CHECK_FULL_TEXT = False
+OABOT_JVM_WORKERS = 2
+OABOT_JVM_HEAP_MB = 512
+OABOT_JVM_TIMEOUT = 60
+OABOT_JVM_DOCUMENTS_PER_WORKER = 500
+
+# Timeout (in seconds) of the requests made to probe candidate URLs
+# before sending them to Zotero
+OABOT_PROBE_TIMEOUT = (5, 10)
+
+# Number of days the per-domain statistics used to rank candidate
+# links are kept after the last check on the domain
+OABOT_DOMAIN_STATS_TTL = 365
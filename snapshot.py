@@ -0,0 +1,152 @@
+# -*- encoding: utf-8 -*-
+"""
+Compact, immutable snapshots of an OnDiskCache.
+
+A snapshot is a single file which is memory-mapped read-only by
+every process using the cache, so all web workers share the same
+pages through the OS page cache instead of each unpickling its own
+copy. Its layout is:
+
+    header    magic, number of entries, number of distinct values
+    hashes    the 64-bit hashes of the keys, sorted (uint64 each)
+    days      the date of each entry, as a day number (uint32 each)
+    values    the index of the value of each entry (uint32 each)
+    offsets   the offsets of the distinct values in the blob (uint32 each,
+              plus one for the end of the blob)
+    blob      the distinct values, pickled
+
+Keys are only stored as hashes: two keys whose hashes collide
+(which is very unlikely with 64 bits) would share an entry.
+"""
+from __future__ import unicode_literals
+import os
+import mmap
+import struct
+import hashlib
+import cPickle
+import datetime
+import tempfile
+from os.path import dirname, abspath
+
+MAGIC = b'OABOTSN1'
+HEADER = struct.Struct(str('<8sII'))
+HASH = struct.Struct(str('<Q'))
+UINT = struct.Struct(str('<I'))
+
+def key_hash(key):
+    if type(key) == unicode:
+        key = key.encode('utf-8')
+    elif type(key) != bytes:
+        key = repr(key)
+    return struct.unpack(str('>Q'), hashlib.md5(key).digest()[:8])[0]
+
+def write_snapshot(path, items):
+    """
+    Writes a snapshot of the given (key, (date, value)) pairs.
+    The file is replaced atomically, so that processes which
+    reopen it never see a partial snapshot.
+    """
+    entries = []
+    values = {}
+    blobs = []
+    for key, (d, v) in items:
+        blob = cPickle.dumps(v, cPickle.HIGHEST_PROTOCOL)
+        idx = values.get(blob)
+        if idx is None:
+            idx = values[blob] = len(blobs)
+            blobs.append(blob)
+        entries.append((key_hash(key), d.toordinal(), idx))
+    entries.sort()
+
+    f = tempfile.NamedTemporaryFile(dir=dirname(abspath(path)),
+                prefix='.tmp-', delete=False)
+    try:
+        with f:
+            f.write(HEADER.pack(MAGIC, len(entries), len(blobs)))
+            for h, _, _ in entries:
+                f.write(HASH.pack(h))
+            for _, day, _ in entries:
+                f.write(UINT.pack(day))
+            for _, _, idx in entries:
+                f.write(UINT.pack(idx))
+            offset = 0
+            for blob in blobs:
+                f.write(UINT.pack(offset))
+                offset += len(blob)
+            f.write(UINT.pack(offset))
+            for blob in blobs:
+                f.write(blob)
+        os.rename(f.name, path)
+    except:
+        os.remove(f.name)
+        raise
+
+class CacheSnapshot(object):
+    """
+    Read-only view on a snapshot file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.view = None
+        self.open()
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, nb_values = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            mm.close()
+            raise ValueError('%s is not a cache snapshot' % self.path)
+        hashes_offset = HEADER.size
+        days_offset = hashes_offset + HASH.size * count
+        values_offset = days_offset + UINT.size * count
+        offsets_offset = values_offset + UINT.size * count
+        blob_offset = offsets_offset + UINT.size * (nb_values + 1)
+        # swapped in one assignment, so that concurrent lookups
+        # always see a consistent view (the previous mapping is
+        # closed when no lookup uses it anymore)
+        self.view = (mm, count, hashes_offset, days_offset,
+                    values_offset, offsets_offset, blob_offset)
+        self.inode = inode
+
+    def refresh(self):
+        """
+        Reopens the snapshot if a new one has been published
+        """
+        try:
+            if os.stat(self.path).st_ino != self.inode:
+                self.open()
+        except (OSError, IOError, ValueError):
+            pass
+
+    def __len__(self):
+        return self.view[1]
+
+    def get(self, key):
+        """
+        Returns the (date, value) pair stored for a key, or None
+        """
+        (mm, count, hashes_offset, days_offset,
+            values_offset, offsets_offset, blob_offset) = self.view
+        h = key_hash(key)
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = HASH.unpack_from(mm, hashes_offset + HASH.size * mid)[0]
+            if cur < h:
+                lo = mid + 1
+            elif cur > h:
+                hi = mid
+            else:
+                break
+        else:
+            return None
+
+        day = UINT.unpack_from(mm, days_offset + UINT.size * mid)[0]
+        value_idx = UINT.unpack_from(mm, values_offset + UINT.size * mid)[0]
+        start, end = struct.unpack_from(str('<II'), mm,
+                    offsets_offset + UINT.size * value_idx)
+        value = cPickle.loads(mm[blob_offset + start:blob_offset + end])
+        return (datetime.date.fromordinal(day), value)
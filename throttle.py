@@ -0,0 +1,188 @@
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+import threading
+from contextlib import contextmanager
+from urlparse import urlparse
+import requests
+from settings import OABOT_MAX_REQUESTS_PER_HOST, OABOT_HOST_CONCURRENCY
+from settings import OABOT_BREAKER_FAILURES, OABOT_BREAKER_RESET, OABOT_HOST_RATE_LIMITS
+
+def host_of(url):
+    """
+    Returns the (lowercased) host name of an URL
+    """
+    return (urlparse(url).hostname or '').lower()
+
+class HostLimiter(object):
+    """
+    Bounds the number of simultaneous requests made to each host,
+    so that resolving citations in parallel does not flood the
+    APIs we rely on.
+    """
+    def __init__(self, max_per_host, overrides=None):
+        """
+        :param max_per_host: the default number of concurrent requests per host
+        :param overrides: a dict mapping host names to their own limit
+        """
+        self.max_per_host = max_per_host
+        self.overrides = overrides or {}
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def semaphore(self, host):
+        with self.lock:
+            sem = self.semaphores.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(
+                    self.overrides.get(host, self.max_per_host))
+                self.semaphores[host] = sem
+            return sem
+
+    @contextmanager
+    def limit(self, url):
+        """
+        Context manager holding one request slot for the host of the URL
+        """
+        with self.semaphore(host_of(url)):
+            yield
+
+host_limiter = HostLimiter(OABOT_MAX_REQUESTS_PER_HOST, OABOT_HOST_CONCURRENCY)
+
+class HostUnavailable(requests.exceptions.ConnectionError):
+    """
+    Raised instead of sending a request to a host which is
+    known to be failing, or whose rate limit is exhausted
+    """
+    def __init__(self, host, reason):
+        super(HostUnavailable, self).__init__('%s is unavailable: %s' % (host, reason))
+        self.host = host
+        self.reason = reason
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to a host after `max_failures`
+    consecutive failures. After `reset_timeout` seconds, one
+    request is let through: the breaker closes again if it succeeds.
+    """
+    def __init__(self, host, max_failures=OABOT_BREAKER_FAILURES,
+                    reset_timeout=OABOT_BREAKER_RESET):
+        self.host = host
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        """
+        Raises HostUnavailable if the breaker is open
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if (time.time() - self.opened_at < self.reset_timeout
+                    or self.trial_running):
+                raise HostUnavailable(self.host,
+                    'circuit breaker open after %d failures' % self.failures)
+            self.trial_running = True
+
+    def cancel_trial(self):
+        """
+        Called when a request let through by before_request was not sent
+        """
+        with self.lock:
+            self.trial_running = False
+
+    def record(self, success):
+        with self.lock:
+            self.trial_running = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.max_failures or self.opened_at is not None:
+                    self.opened_at = time.time()
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests per second on average,
+    with bursts of up to `burst` requests
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, max_wait=None):
+        """
+        Takes a token, waiting for at most max_wait seconds
+        (forever if None). Returns False if no token could be taken.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if max_wait is not None:
+                if wait > max_wait:
+                    return False
+                max_wait -= wait
+            time.sleep(wait)
+
+class HostGuard(object):
+    """
+    The circuit breaker and rate limiter of each upstream API
+    listed in `rate_limits` (other hosts are not guarded)
+    """
+    def __init__(self, rate_limits):
+        self.breakers = {}
+        self.buckets = {}
+        for host, (rate, burst) in rate_limits.items():
+            self.breakers[host] = CircuitBreaker(host)
+            self.buckets[host] = TokenBucket(rate, burst)
+
+    def before_request(self, host, max_wait=None):
+        """
+        Raises HostUnavailable if the host is failing or if it
+        cannot be sent a request within max_wait seconds
+        """
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            return
+        breaker.before_request()
+        if not self.buckets[host].acquire(max_wait):
+            breaker.cancel_trial()
+            raise HostUnavailable(host, 'rate limit exceeded')
+
+    def record(self, host, success):
+        breaker = self.breakers.get(host)
+        if breaker is not None:
+            breaker.record(success)
+
+    def cancel(self, host):
+        """
+        Called when a request allowed by before_request
+        did not tell us anything about the host
+        """
+        breaker = self.breakers.get(host)
+        if breaker is not None:
+            breaker.cancel_trial()
+
+    def status(self):
+        """
+        Hosts whose circuit breaker is currently open
+        """
+        return [host for host, breaker in self.breakers.items()
+                if breaker.opened_at is not None]
+
+host_guard = HostGuard(OABOT_HOST_RATE_LIMITS)
@@ -0,0 +1,79 @@
+# -*- encoding: utf-8 -*-
+from __future__ import unicode_literals
+import re
+from urllib import urlencode
+from urlparse import urlsplit, urlunsplit, parse_qsl
+
+# Query parameters which only track where visitors come from
+tracking_params_re = re.compile(
+    r'^(utm_.*|fbclid|gclid|dclid|mc_cid|mc_eid|_ga|ref|referrer|source|origin)$',
+    re.IGNORECASE)
+
+# Session identifiers embedded in paths (Java servlets)
+path_session_re = re.compile(r';(jsessionid|sid)=[^/?#]*', re.IGNORECASE)
+
+host_aliases = {
+    'dx.doi.org': 'doi.org',
+}
+
+def canonical_url(url):
+    """
+    Reduces an URL to a canonical form, so that URLs pointing to
+    the same resource are equal: http and https are merged, 'www.'
+    and default ports are removed, doi.org aliases are unified,
+    tracking parameters and fragments are dropped and the remaining
+    query parameters are sorted.
+
+    The canonical form is only meant to be compared: it should not
+    be used to fetch the resource.
+    """
+    if not url:
+        return url
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    if scheme not in ('http', 'https'):
+        return url.strip()
+
+    host = (parts.hostname or '').rstrip('.')
+    if host.startswith('www.'):
+        host = host[4:]
+    host = host_aliases.get(host, host)
+    if port and port not in (80, 443):
+        host = '%s:%d' % (host, port)
+
+    path = path_session_re.sub('', parts.path) or '/'
+    if host == 'doi.org':
+        # DOIs are case-insensitive
+        path = path.lower()
+
+    # parse the query as bytes, so that percent-encoded
+    # UTF-8 characters are decoded and encoded back unchanged
+    query = parts.query
+    if type(query) == unicode:
+        query = query.encode('utf-8')
+    params = [(k, v) for k, v in parse_qsl(query, keep_blank_values=True)
+                if not tracking_params_re.match(k)]
+    query = urlencode(sorted(params)).decode('utf-8')
+
+    return urlunsplit(('https', host, path, query, ''))
+
+def dedupe_urls(urls):
+    """
+    Removes empty URLs and URLs whose canonical form has already
+    been seen, keeping the first occurrence of each.
+    """
+    seen = set()
+    result = []
+    for url in urls:
+        if not url:
+            continue
+        key = canonical_url(url)
+        if key in seen:
+            continue
+        seen.add(key)
+        result.append(url)
+    return result
@@ -1,17 +1,46 @@
-
+"""
+Rendering of wikicode (citation templates) to HTML with the API of
+Wikipedia. Templates are rendered in batches, with one action=parse
+request whose output is split back into fragments, and the fragments
+are cached by the hash of their wikicode (the orig_hash of edits).
+"""
+import httpclient
 import requests
 import json
+import re
+import hashlib
+from datetime import timedelta
 
 from jinja2 import evalcontextfilter, Markup
+from settings import *
+from ondiskcache import OnDiskCache
 
-@evalcontextfilter
-def wikirender(eval_ctx, wikicode):
+fragments_cache = OnDiskCache('rendered_templates.sqlite',
+            ttl=timedelta(days=OABOT_RENDER_CACHE_TTL),
+            capacity=OABOT_CACHE_CAPACITY)
+fragments_cache.start_flushing(OABOT_CACHE_FLUSH_INTERVAL, OABOT_CACHE_FLUSH_BATCH)
+
+# inserted between the templates of a batch, and looked for in the output
+separator = u'<div class="oabot-separator"></div>'
+separator_re = re.compile(r'\s*(?:<p>\s*)?<div class="oabot-separator">\s*</div>(?:\s*</p>)?\s*')
+
+def fragment_key(wikicode):
     """
-    Converts wikicode to the resulting HTML
+    The hash of a piece of wikicode (as the orig_hash of edits)
     """
-    r = requests.get('https://en.wikipedia.org/w/api.php',
-        {'action':'parse',
+    return hashlib.md5(wikicode.encode('utf-8')).hexdigest()
+
+def parse(wikicode):
+    """
+    Converts wikicode to HTML with one API request
+    """
+    r = httpclient.post('https://en.wikipedia.org/w/api.php',
+        data={'action':'parse',
          'text':wikicode,
+         'contentmodel':'wikitext',
+         'disablelimitreport':1,
+         'disableeditsection':1,
+         'wrapoutputclass':'',
          'format':'json',
         })
     result = r.json().get('parse',{}).get('text', {}).get('*','')
@@ -19,9 +48,55 @@ def wikirender(eval_ctx, wikicode):
     result = result.replace('href="/wiki/',
             'href="https://en.wikipedia.org/wiki/')
     result = result.replace('<a ','<a target="_blank" ')
+    return result
+
+def render_batch(wikicodes):
+    """
+    Converts several pieces of wikicode to HTML with one API request.
+    If the output cannot be split back, they are rendered one by one.
+    """
+    if len(wikicodes) == 1:
+        return [parse(wikicodes[0])]
+    text = (u'\n\n%s\n\n' % separator).join(wikicodes)
+    fragments = separator_re.split(parse(text).strip())
+    if len(fragments) != len(wikicodes):
+        return [parse(wikicode) for wikicode in wikicodes]
+    return fragments
+
+def prerender(wikicodes):
+    """
+    Makes sure that the given pieces of wikicode are rendered in the
+    cache, rendering the missing ones by batches of OABOT_RENDER_BATCH.
+    Failures are ignored: the filter renders what is still missing.
+    """
+    missing = []
+    for wikicode in wikicodes:
+        if wikicode not in missing and fragment_key(wikicode) not in fragments_cache:
+            missing.append(wikicode)
+    for start in range(0, len(missing), OABOT_RENDER_BATCH):
+        batch = missing[start:start+OABOT_RENDER_BATCH]
+        try:
+            fragments = render_batch(batch)
+        except (requests.exceptions.RequestException, ValueError):
+            # the filter will try again when they are displayed
+            continue
+        for wikicode, html in zip(batch, fragments):
+            if html:
+                fragments_cache.set(fragment_key(wikicode), html)
+
+@evalcontextfilter
+def wikirender(eval_ctx, wikicode):
+    """
+    Converts wikicode to the resulting HTML
+    (from the cache, if it has been rendered before)
+    """
+    result = fragments_cache.get(fragment_key(wikicode))
+    if result is None:
+        result = parse(wikicode)
+        if result:
+            fragments_cache.set(fragment_key(wikicode), result)
 
     if eval_ctx.autoescape:
         result = Markup(result) or wikicode
     return result or wikicode
 
-